@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import optparse
+import sys
+
+# Reuse the settings configured for the test suite.
+import runtests
+
+from django.conf import settings
+from django.test.simple import DjangoTestSuiteRunner
+from django.utils import unittest
+
+
+class BenchmarkRunner(DjangoTestSuiteRunner):
+    """ Runs the benchmarks instead of the regular test suite """
+
+    def build_suite(self, test_labels, extra_tests=None, **kwargs):
+        from broadcast.tests import benchmarks
+        loader = unittest.defaultTestLoader
+        if test_labels:
+            names = ['broadcast.tests.benchmarks.{0}'.format(label)
+                     for label in test_labels]
+            return loader.loadTestsFromNames(names)
+        return loader.loadTestsFromModule(benchmarks)
+
+
+def benchmark():
+    from broadcast.tests.benchmarks import OPTIONS
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    for name, default in sorted(OPTIONS.items()):
+        kind = isinstance(default, int) and 'int' or 'string'
+        parser.add_option('--{0}'.format(name), type=kind, default=default,
+                          help='default: %default')
+    options, benchmarks = parser.parse_args()
+    OPTIONS.update(vars(options))
+
+    runner = BenchmarkRunner(verbosity=1, interactive=False, failfast=False)
+    sys.exit(runner.run_tests(benchmarks))
+
+
+if __name__ == '__main__':
+    benchmark()
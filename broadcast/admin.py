@@ -1,8 +1,73 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from django.conf.urls import patterns, url
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import InvalidPage, Paginator
+from django.http import HttpResponseRedirect
+from django.shortcuts import render
 
 from broadcast import models as broadcast
+from broadcast.views import approximate_count
+
+
+class EstimatedCountPaginator(Paginator):
+    """ Paginator which doesn't count more rows than it has to """
+
+    def _get_count(self):
+        if self._count is None:
+            filtered = bool(self.object_list.query.where)
+            self._count = approximate_count(self.object_list, filtered)[0]
+        return self._count
+    count = property(_get_count)
+
+
+class EstimatedCountChangeList(ChangeList):
+    """ ChangeList which estimates the unfiltered number of rows too """
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set,
+                                                   self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = approximate_count(self.root_query_set,
+                                                  False)[0]
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+def requeue_errors(modeladmin, request, queryset):
+    """ Queue the failed messages of the selected broadcasts again """
+    manager = broadcast.BroadcastMessage.objects
+    count = manager.requeue(manager.filter(broadcast__in=queryset))
+    modeladmin.message_user(request, '{0} message(s) queued again'.format(
+        count))
+requeue_errors.short_description = 'Queue failed messages again'
+
+
+def cancel_queued(modeladmin, request, queryset):
+    """ Cancel the queued messages of the selected broadcasts """
+    manager = broadcast.BroadcastMessage.objects
+    count = manager.cancel(manager.filter(broadcast__in=queryset))
+    count += broadcast.RecipientSnapshot.objects.cancel(queryset)
+    modeladmin.message_user(request, '{0} message(s) cancelled'.format(count))
+cancel_queued.short_description = 'Cancel queued messages'
 
 
 class BroadcastAdmin(admin.ModelAdmin):
@@ -10,16 +75,105 @@ class BroadcastAdmin(admin.ModelAdmin):
     list_filter = ('date_created', 'date_last_notified')
     search_fields = ('body',)
     ordering = ('-date_last_notified',)
+    actions = [requeue_errors, cancel_queued]
 
 admin.site.register(broadcast.Broadcast, BroadcastAdmin)
 
 
 class BroadcastMessageAdmin(admin.ModelAdmin):
-    list_display = ('id', 'recipient', 'date_created', 'date_sent')
-    list_filter = ('date_created', 'date_sent')
-    ordering = ('-date_created',)
+    list_display = ('id', 'broadcast', 'recipient', 'status', 'date_created',
+                    'date_sent')
+    # status is indexed, unlike the date filters which had to scan
+    list_filter = ('status',)
+    list_select_related = True
+    raw_id_fields = ('broadcast', 'recipient', 'connection')
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    actions = ['requeue', 'cancel']
+    change_list_template = 'admin/broadcast/broadcastmessage/change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+    def requeue(self, request, queryset):
+        count = broadcast.BroadcastMessage.objects.requeue(queryset)
+        self.message_user(request, '{0} message(s) queued again'.format(
+            count))
+    requeue.short_description = 'Queue failed messages again'
+
+    def cancel(self, request, queryset):
+        count = broadcast.BroadcastMessage.objects.cancel(queryset)
+        self.message_user(request, '{0} message(s) cancelled'.format(count))
+    cancel.short_description = 'Cancel queued messages'
+
+    def get_urls(self):
+        urls = patterns('',
+            url(r'^backlog/$', self.admin_site.admin_view(self.backlog),
+                name='broadcast_broadcastmessage_backlog'),
+        )
+        return urls + super(BroadcastMessageAdmin, self).get_urls()
+
+    def backlog(self, request):
+        """ Queued messages by broadcast, age and backend """
+        manager = broadcast.BroadcastMessage.objects
+        if request.method == 'POST':
+            try:
+                broadcast_id = int(request.POST.get('broadcast'))
+            except (TypeError, ValueError):
+                return HttpResponseRedirect(request.path)
+            selected = manager.filter(broadcast=broadcast_id)
+            if request.POST.get('action') == 'requeue':
+                count = manager.requeue(selected)
+                self.message_user(request, '{0} message(s) queued '
+                                  'again'.format(count))
+            elif request.POST.get('action') == 'cancel':
+                count = manager.cancel(selected)
+                count += broadcast.RecipientSnapshot.objects.cancel(
+                    [broadcast_id])
+                self.message_user(request, '{0} message(s) '
+                                  'cancelled'.format(count))
+            return HttpResponseRedirect(request.path)
+        context = manager.backlog()
+        context['title'] = 'Broadcast message backlog'
+        context['opts'] = self.model._meta
+        return render(request, 'admin/broadcast/broadcastmessage/backlog.html',
+                      context)
 
 admin.site.register(broadcast.BroadcastMessage, BroadcastMessageAdmin)
 
 
 admin.site.register(broadcast.ForwardingRule)
+
+
+class RecipientSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('broadcast', 'date_created', 'size', 'position',
+                    'exception_rows')
+    raw_id_fields = ('broadcast',)
+    exclude = ('recipients',)
+
+admin.site.register(broadcast.RecipientSnapshot, RecipientSnapshotAdmin)
+
+
+class RecipientClaimAdmin(admin.ModelAdmin):
+    list_display = ('snapshot', 'start', 'end', 'worker', 'lease_expires')
+    raw_id_fields = ('snapshot',)
+
+admin.site.register(broadcast.RecipientClaim, RecipientClaimAdmin)
+
+
+class DailyMessageCountAdmin(admin.ModelAdmin):
+    list_display = ('date', 'direction', 'source', 'backend', 'rule',
+                    'broadcast', 'count')
+    list_filter = ('direction', 'source', 'backend')
+    raw_id_fields = ('rule', 'broadcast')
+    date_hierarchy = 'date'
+
+admin.site.register(broadcast.DailyMessageCount, DailyMessageCountAdmin)
+
+
+class UsageReportAdmin(admin.ModelAdmin):
+    list_display = ('month', 'subject', 'date_created', 'date_sent')
+    readonly_fields = ('context',)
+    date_hierarchy = 'month'
+
+admin.site.register(broadcast.UsageReport, UsageReportAdmin)
@@ -1,19 +1,31 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import calendar
 import datetime
 import logging
+import os
+import socket
+import time
 
 from django.conf import settings
 from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Count, F, Max, Sum
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.timezone import now as get_now
 
 from rapidsms.apps.base import AppBase
+from rapidsms.contrib.messagelog.models import Message
 from rapidsms.messages import OutgoingMessage
 from rapidsms.router import send
 
-from broadcast.models import Broadcast, BroadcastMessage, ForwardingRule
-from broadcast.views import usage_report_context
+from broadcast import metrics, profiling
+from broadcast.models import (ArchivedBroadcastMessage, Broadcast,
+    BroadcastMessage, BroadcastStats, ForwardingRule, DailyMessageCount,
+    HighWaterMark, RecipientClaim, RecipientSnapshot, UsageReport,
+    date_trunc_select, preferred_connections, truncated_date)
+from broadcast.views import is_closed_period, usage_report_context
 from groups import models as groups
 
 # In RapidSMS, message translation is done in OutgoingMessage, so no need
@@ -28,60 +40,403 @@ logger = logging.getLogger('broadcast.app')
 def scheduler_callback():
     """ Prepare and send broadcast messages. """
     logger.info('Starting cron job.')
-    queue_outgoing_messages()
-    send_queued_messages()
+    with profiling.profiled('scheduler_callback') as profile:
+        with metrics.timed('queue'):
+            queue_outgoing_messages(profile)
+        with metrics.timed('send'):
+            send_queued_messages(profile)
+        with profile.stage('metrics'):
+            update_queue_metrics()
 
 
-def queue_outgoing_messages():
+def queue_outgoing_messages(profile=None):
     """ Generate queued messages for scheduled broadcasts. """
-    broadcasts = Broadcast.ready.all()
-    logger.info('Found {0} ready broadcast(s)'.format(broadcasts.count()))
-    for broadcast in broadcasts:
-        # TODO: make sure this process is atomic
-        count = broadcast.queue_outgoing_messages()
-        logger.debug('Queued {0} broadcast message(s)'.format(count))
-        broadcast.set_next_date()
-        broadcast.save()
-
-
-def send_queued_messages():
-    """ Send messages which have been queued for delivery. """
-    messages = BroadcastMessage.objects.filter(status='queued')[:50]
-    logger.info('Found {0} message(s) to send'.format(messages.count()))
+    with profiling.profiled('queue_outgoing_messages', profile) as profile:
+        with profile.stage('find_ready'):
+            broadcasts = list(Broadcast.ready.all())
+        logger.info('Found {0} ready broadcast(s)'.format(len(broadcasts)))
+        for broadcast in broadcasts:
+            # TODO: make sure this process is atomic
+            with profile.stage('fan_out', broadcast.pk):
+                count = broadcast.queue_outgoing_messages()
+            logger.debug('Queued {0} broadcast message(s)'.format(count))
+            with profile.stage('set_next_date', broadcast.pk):
+                broadcast.set_next_date()
+                broadcast.save()
+
+
+def send_queued_messages(profile=None, worker=None):
+    """
+    Send messages which have been queued for delivery. Messages are leased
+    to worker (the host name and process id by default) while they are
+    sent, so several senders can run at once.
+    """
+    with profiling.profiled('send_queued_messages', profile) as profile:
+        _send_queued_messages(profile, worker or worker_id())
+
+
+def worker_id():
+    """ Identifies this process among the senders """
+    return u'{0}:{1}'.format(socket.gethostname(), os.getpid())[:64]
+
+
+def _send_queued_messages(profile, worker, batch_size=50):
+    with profile.stage('find_queued'):
+        messages = BroadcastMessage.objects.claim(batch_size, worker)
+    logger.info('Claimed {0} message(s) to send'.format(len(messages)))
+    with profile.stage('resolve_connection'):
+        # messages queued before connections were bound at queue time
+        unbound = [m.recipient_id for m in messages if not m.connection_id]
+        connections = unbound and preferred_connections(unbound) or {}
+    results = _SendResults()
     for message in messages:
-        connection = message.recipient.default_connection
-        try:
-            msg = send(message.broadcast.body, connection)[0]
-        except Exception, e:
-            msg = None
-            logger.exception(e)
+        connection = message.connection or \
+            connections.get(message.recipient_id)
+        with profile.stage('backend_send', message.broadcast_id):
+            msg = _send(message.broadcast.body, connection)
+        status = 'sent'
         if msg:
-            logger.debug('Message sent successfully!')
             message.status = 'sent'
             message.date_sent = get_now()
+            message.external_id = unicode(getattr(msg, 'id', None) or u'')
+            message.attempts += 1
+        elif message.failed(get_now(), transient=bool(connection)):
+            status = 'retry'
+        else:
+            status = 'error'
+        with profile.stage('save', message.broadcast_id):
+            updated = BroadcastMessage.objects.filter(
+                pk=message.pk, status='sending', worker=worker,
+            ).update(status=message.status, date_sent=message.date_sent,
+                     external_id=message.external_id,
+                     attempts=message.attempts,
+                     next_attempt=message.next_attempt, lease_expires=None)
+        if not updated:
+            logger.warning(u'Lease of message {0} expired while it was '
+                           u'sent'.format(message.pk))
+            continue
+        results.add(message.broadcast_id, status, message.date_created,
+                    message.date_sent, connection)
+    if len(messages) < batch_size:
+        _send_snapshot_recipients(profile, batch_size - len(messages),
+                                  results, worker)
+    for broadcast_id, (sent, errors) in results.broadcasts.items():
+        with profile.stage('stats', broadcast_id):
+            BroadcastStats.objects.add_results(broadcast_id, sent, errors)
+    for (status, backend), count in results.backends.items():
+        metrics.incr(status, count, backend=backend)
+
+
+def _send_snapshot_recipients(profile, limit, results, worker):
+    """
+    Send to up to limit recipients of compact mode snapshots. Recipients
+    which fail get a BroadcastMessage, queued for a retry, or with status
+    'unreachable' if they have no connection.
+    """
+    with profile.stage('find_queued'):
+        claims = RecipientSnapshot.objects.claim(limit, worker)
+    for claim in claims:
+        snapshot = claim.snapshot
+        broadcast_id = snapshot.broadcast_id
+        contact_ids = claim.get_recipients()
+        with profile.stage('resolve_connection', broadcast_id):
+            connections = preferred_connections(list(contact_ids))
+        failed = []
+        # (status, date sent, connection) of each recipient
+        outcomes = []
+        for contact_id in contact_ids:
+            connection = connections.get(contact_id)
+            msg = None
+            if connection:
+                with profile.stage('backend_send', broadcast_id):
+                    msg = _send(snapshot.broadcast.body, connection)
+            if msg:
+                outcomes.append(('sent', get_now(), connection))
+                continue
+            message = BroadcastMessage(
+                broadcast_id=broadcast_id, recipient_id=contact_id,
+                connection=connection, body_hash=snapshot.body_hash,
+                date_created=get_now())
+            if not connection:
+                message.status = 'unreachable'
+                status = 'error'
+            elif message.failed(get_now()):
+                status = 'retry'
+            else:
+                status = 'error'
+            failed.append(message)
+            outcomes.append((status, None, connection))
+        with profile.stage('save', broadcast_id):
+            with transaction.commit_on_success():
+                # the claim is lost if its lease expired and another sender
+                # took it over, which then sends to its recipients again
+                owned = RecipientClaim.objects.filter(
+                    pk=claim.pk, worker=worker).update(worker=worker)
+                if owned:
+                    RecipientClaim.objects.filter(pk=claim.pk).delete()
+                    # sent recipients have no row for update_message_counts
+                    # to roll up, so they are counted here
+                    sent = len([o for o in outcomes if o[0] == 'sent'])
+                    if sent:
+                        DailyMessageCount.objects.increment(
+                            sent, truncated_date(get_now()), 'O',
+                            'broadcast', rule=snapshot.broadcast.forward_id,
+                            broadcast=broadcast_id)
+                if owned and failed:
+                    BroadcastMessage.objects.bulk_create(failed)
+                    RecipientSnapshot.objects.filter(pk=snapshot.pk).update(
+                        exception_rows=F('exception_rows') + len(failed))
+        if not owned:
+            logger.warning(u'Lease of recipients {0} to {1} of snapshot {2} '
+                           u'expired while they were sent'.format(
+                               claim.start, claim.end, snapshot.pk))
+            continue
+        for status, date_sent, connection in outcomes:
+            results.add(broadcast_id, status, snapshot.date_created,
+                        date_sent, connection)
+
+
+def _send(body, connection):
+    """ Send body to connection, returning the message or None on error """
+    try:
+        msg = send(body, connection)[0]
+    except Exception, e:
+        msg = None
+        logger.exception(e)
+    if msg:
+        logger.debug('Message sent successfully!')
+    else:
+        logger.debug('Message failed to send.')
+    return msg
+
+
+class _SendResults(object):
+    """ Results of a batch of messages, by broadcast and by backend """
+
+    def __init__(self):
+        # broadcast id -> ([(date_created, date_sent), ...], number of errors)
+        self.broadcasts = {}
+        # (status, backend id) -> number of messages
+        self.backends = {}
+
+    def add(self, broadcast_id, status, date_created, date_sent, connection):
+        """ Count a message which was 'sent', 'error' or queued to 'retry' """
+        key = ({'sent': 'sent', 'retry': 'retries'}.get(status, 'errors'),
+               connection and connection.backend_id or 'none')
+        self.backends[key] = self.backends.get(key, 0) + 1
+        if status == 'retry':
+            # still queued as far as the delivery stats are concerned
+            return
+        sent, errors = self.broadcasts.get(broadcast_id, ([], 0))
+        if status == 'sent':
+            sent.append((date_created, date_sent))
+        else:
+            errors += 1
+        self.broadcasts[broadcast_id] = (sent, errors)
+
+
+def update_queue_metrics():
+    """ Record the number of queued messages and the age of the oldest """
+    stats = BroadcastStats.objects.filter(queued__gt=0)
+    depth = stats.aggregate(depth=Sum('queued'))['depth'] or 0
+    metrics.set_gauge('queue_depth', depth)
+    dates = list(BroadcastMessage.objects.filter(
+        status='queued',
+    ).order_by('pk').values_list('date_created', flat=True)[:1])
+    # recipients of compact mode snapshots
+    dates.extend(RecipientSnapshot.objects.pending().order_by(
+        'pk').values_list('date_created', flat=True)[:1])
+    oldest = None
+    if dates:
+        date = min(dates)
+        if timezone.is_aware(date):
+            oldest = calendar.timegm(date.utctimetuple())
         else:
-            logger.debug('Message failed to send.')
-            message.status = 'error'
-        message.save()
+            oldest = time.mktime(date.timetuple())
+    metrics.set_gauge('oldest_queued_timestamp', oldest)
+
+
+def update_message_counts(batch_size=10000):
+    """ Add messages created since the last run to the daily counts. """
+    _update_counts('messagelog', Message, 'date', batch_size,
+                   _message_log_counts)
+    _update_counts('broadcastmessage', BroadcastMessage, 'date_created',
+                   batch_size, _broadcast_message_counts)
+
+
+def _message_log_counts(messages):
+    messages = messages.values('day', 'direction', 'connection__backend')
+    for row in messages.annotate(count=Count('id')).order_by():
+        yield row['count'], {
+            'date': truncated_date(row['day']),
+            'direction': row['direction'],
+            'source': 'log',
+            'backend': row['connection__backend'],
+        }
+
+
+def _broadcast_message_counts(messages):
+    messages = messages.values('day', 'broadcast', 'broadcast__forward')
+    for row in messages.annotate(count=Count('id')).order_by():
+        yield row['count'], {
+            'date': truncated_date(row['day']),
+            'direction': 'O',
+            'source': 'broadcast',
+            'rule': row['broadcast__forward'],
+            'broadcast': row['broadcast'],
+        }
+
+
+def _update_counts(name, model, date_field, batch_size, grouped_counts):
+    """
+    Roll up rows of model with ids above the high-water mark called name,
+    batch_size ids at a time. grouped_counts turns a queryset of rows,
+    annotated with their truncated 'day', into (count, row key) pairs.
+
+    Only rows older than BROADCAST_COUNT_LAG_SECONDS (60 by default) are
+    counted, so rows with lower ids whose transactions haven't committed
+    yet aren't skipped. The mark is locked while a batch is counted and
+    re-read, so overlapping runs don't count the same rows twice.
+    """
+    lag = getattr(settings, 'BROADCAST_COUNT_LAG_SECONDS', 60)
+    cutoff = get_now() - datetime.timedelta(seconds=lag)
+    HighWaterMark.objects.get_or_create(name=name)
+    settled = model.objects.filter(**{date_field + '__lte': cutoff})
+    last_id = settled.aggregate(Max('id'))['id__max'] or 0
+    day = date_trunc_select(model, date_field, 'day')
+    while True:
+        with transaction.commit_on_success():
+            mark = HighWaterMark.objects.select_for_update().get(name=name)
+            if mark.last_id >= last_id:
+                break
+            upper = min(mark.last_id + batch_size, last_id)
+            rows = model.objects.filter(id__gt=mark.last_id, id__lte=upper)
+            rows = rows.extra(select={'day': day})
+            for count, key in grouped_counts(rows):
+                DailyMessageCount.objects.increment(count, **key)
+            mark.last_id = upper
+            mark.save()
+        logger.debug('Counted {0} rows up to id {1}'.format(name, upper))
+    # the counts are up to date as of the cutoff, even if there was nothing
+    # new
+    HighWaterMark.objects.filter(name=name).exclude(
+        date_updated__gte=cutoff).update(date_updated=cutoff)
+
+
+def archive_broadcast_messages(days=None, batch_size=500):
+    """
+    Move sent, failed and cancelled messages created more than days ago
+    (BROADCAST_ARCHIVE_DAYS, 90 by default) to the archive table, a batch
+    at a time. Only messages already added to the daily counts are moved.
+    Returns the number of messages archived.
+    """
+    if days is None:
+        days = getattr(settings, 'BROADCAST_ARCHIVE_DAYS', 90)
+    cutoff = get_now() - datetime.timedelta(days=days)
+    mark, _ = HighWaterMark.objects.get_or_create(name='broadcastmessage')
+    old = BroadcastMessage.objects.filter(
+        status__in=ArchivedBroadcastMessage.ARCHIVED_STATUSES,
+        date_created__lt=cutoff, id__lte=mark.last_id,
+    ).order_by('id')
+    fields = ('id', 'broadcast', 'recipient', 'connection', 'date_created',
+              'date_sent', 'status', 'external_id', 'date_delivered',
+              'attempts')
+    # foreign keys are read as ids, so they are set by attribute name
+    attnames = [ArchivedBroadcastMessage._meta.get_field(field).attname
+                for field in fields]
+    archived, last_id = 0, 0
+    while True:
+        rows = old.filter(id__gt=last_id).values_list(*fields)
+        rows = list(rows[:batch_size])
+        if not rows:
+            break
+        with transaction.commit_on_success():
+            ArchivedBroadcastMessage.objects.bulk_create([
+                ArchivedBroadcastMessage(**dict(zip(attnames, row)))
+                for row in rows
+            ])
+            BroadcastMessage.objects.filter(
+                id__in=[row[0] for row in rows]).delete()
+        archived += len(rows)
+        last_id = rows[-1][0]
+        logger.debug('Archived broadcast messages up to id {0}'.format(
+            last_id))
+    logger.info('Archived {0} broadcast message(s)'.format(archived))
+    return archived
 
 
 def usage_email_callback(router, *args, **kwargs):
     """ Send out month email report of broadcast usage. """
+    month = last_month()
+    try:
+        report = UsageReport.objects.get(month=month)
+    except UsageReport.DoesNotExist:
+        logger.warning('Usage report of {0} was not built in advance'.format(
+            month.strftime('%B %Y')))
+        # count the latest messages, and only store the report once the
+        # counts of the month are final
+        update_message_counts()
+        end_date = month.replace(day=calendar.monthrange(month.year,
+                                                         month.month)[1])
+        report = build_usage_report(month, save=is_closed_period(end_date))
+    send_usage_report(report)
+
+
+def last_month():
+    """ First day of the previous month """
     today = datetime.date.today()
     report_date = today - datetime.timedelta(days=today.day)
-    start_date = datetime.date(report_date.year, report_date.month, 1)
-    end_date = report_date
+    return report_date.replace(day=1)
+
+
+def build_usage_reports():
+    """ Build last month's usage report once its message counts are final """
+    month = last_month()
+    end_date = month.replace(day=calendar.monthrange(month.year,
+                                                     month.month)[1])
+    exists = UsageReport.objects.filter(month=month).exists()
+    if not exists and is_closed_period(end_date):
+        build_usage_report(month)
+
+
+def build_usage_report(month, save=True):
+    """
+    Build, or rebuild, the stored usage report of the month starting on the
+    given date. The report isn't stored if save is False.
+    """
+    start_date = month.replace(day=1)
+    end_date = month.replace(day=calendar.monthrange(month.year,
+                                                     month.month)[1])
     context = usage_report_context(start_date, end_date)
-    context['report_month'] = report_date.strftime('%B')
-    context['report_year'] = report_date.strftime('%Y')
+    try:
+        report = UsageReport.objects.get(month=start_date)
+    except UsageReport.DoesNotExist:
+        report = UsageReport(month=start_date)
+    report.set_context(context)
+    context = dict(context)
+    context['report_month'] = start_date.strftime('%B')
+    context['report_year'] = start_date.strftime('%Y')
     subject_template = _(u'TrialConnect Monthly Report - {report_month} {report_year}')
-    subject = subject_template.format(**context)
-    body = render_to_string('broadcast/emails/usage_report_message.html', context)
+    report.subject = subject_template.format(**context)
+    report.body = render_to_string('broadcast/emails/usage_report_message.html', context)
+    if save:
+        report.save()
+        logger.info('Built usage report of {0}'.format(report.month))
+    return report
+
+
+def send_usage_report(report):
+    """ Email a usage report to the monthly report group """
     group_name = settings.DEFAULT_MONTHLY_REPORT_GROUP_NAME
     group, created = groups.Group.objects.get_or_create(name=group_name)
-    if not created:
-        emails = [c.email for c in group.contacts.all() if c.email]
-        send_mail(subject, body, None, emails, fail_silently=True)
+    if created:
+        return
+    emails = group.contacts.exclude(email__isnull=True).exclude(email=u'')
+    emails = list(emails.values_list('email', flat=True))
+    send_mail(report.subject, report.body, None, emails, fail_silently=True)
+    report.date_sent = get_now()
+    if report.pk:
+        report.save()
 
 
 class BroadcastApp(AppBase):
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import logging
+import time
+
+from django.core.cache import cache
+
+
+logger = logging.getLogger('broadcast.caching')
+
+# Longest timeout that all cache backends treat as "don't expire"
+FOREVER = 60 * 60 * 24 * 365
+
+# How long a computation may hold the lock before others give up on it
+LOCK_TIMEOUT = 30
+
+# How long a previous value is kept to serve while it is being recomputed
+STALE_TIMEOUT = 60 * 60
+
+
+def get_version(name):
+    """ Returns the current version number of a group of cache keys """
+    key = 'broadcast:version:{0}'.format(name)
+    version = cache.get(key)
+    if version is None:
+        version = 1
+        cache.add(key, version, FOREVER)
+    return version
+
+
+def get_versions(names):
+    """
+    Returns a dictionary of the current version numbers of several groups
+    of cache keys, looked up at once
+    """
+    keys = dict([('broadcast:version:{0}'.format(name), name)
+                 for name in names])
+    found = cache.get_many(keys.keys())
+    versions = {}
+    for key, name in keys.items():
+        version = found.get(key)
+        if version is None:
+            version = 1
+            cache.add(key, version, FOREVER)
+        versions[name] = version
+    return versions
+
+
+def bump_version(name):
+    """ Invalidates a group of cache keys by moving to a new version """
+    key = 'broadcast:version:{0}'.format(name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, FOREVER)
+
+
+def get_or_compute(key, func, timeout, lock_timeout=LOCK_TIMEOUT):
+    """
+    Returns the cached value for key, calling func to compute and cache it
+    on a miss. Only one caller computes a missing value at a time: the
+    others are served the previous value if there is one, or wait for the
+    computation to finish.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+    lock_key = '{0}:lock'.format(key)
+    stale_key = '{0}:stale'.format(key)
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            value = func()
+            cache.set(key, value, timeout)
+            cache.set(stale_key, value, max(timeout, STALE_TIMEOUT))
+        finally:
+            cache.delete(lock_key)
+        return value
+    value = cache.get(stale_key)
+    if value is not None:
+        return value
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(0.1)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    logger.warning('Gave up waiting for {0} to be computed'.format(key))
+    return func()
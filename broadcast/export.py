@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Export of broadcast delivery logs.
+
+Messages are read in primary key order, a chunk at a time, so an export
+of any size runs in constant memory and can be streamed as it is produced.
+"""
+import csv
+import heapq
+import itertools
+
+from django.utils import simplejson as json
+
+from rapidsms.models import Connection
+
+
+FIELDS = ('id', 'broadcast', 'body', 'status', 'date_created', 'date_sent',
+          'recipient', 'recipient_name', 'identity', 'backend')
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def export_rows(messages, chunk_size=1000):
+    """
+    Yields one dictionary with FIELDS per message of a BroadcastMessage
+    queryset, or of a list of querysets of models with the same fields,
+    such as archived messages, merged in id order. The identity and backend
+    are those of the connection the message was queued to; for messages
+    queued before connections were stored, the recipient's default
+    connections are looked up once per chunk.
+    """
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    rows = heapq.merge(*[_values(queryset, chunk_size)
+                         for queryset in messages])
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        unbound = [row[6] for row in chunk if row[8] is None]
+        connections = unbound and _default_connections(unbound) or {}
+        for row in chunk:
+            identity, backend = row[8:]
+            if identity is None:
+                identity, backend = connections.get(row[6], (u'', u''))
+            yield dict(zip(FIELDS, row[:8] + (identity, backend)))
+
+
+def _values(messages, chunk_size):
+    """ Yields the exported values of messages in id order, by chunks """
+    messages = messages.order_by('pk').values_list(
+        'pk', 'broadcast', 'broadcast__body', 'status', 'date_created',
+        'date_sent', 'recipient', 'recipient__name', 'connection__identity',
+        'connection__backend__name',
+    )
+    last_id = 0
+    while True:
+        chunk = list(messages.filter(pk__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        for row in chunk:
+            yield row
+        last_id = chunk[-1][0]
+
+
+def _default_connections(contact_ids):
+    """
+    Maps contact ids to the (identity, backend name) of their default
+    connection, which is their first one (see Contact.default_connection).
+    """
+    connections = Connection.objects.filter(contact__in=set(contact_ids))
+    connections = connections.order_by('-pk').values_list(
+        'contact', 'identity', 'backend__name')
+    return dict([(contact, (identity, backend))
+                 for contact, identity, backend in connections])
+
+
+def _format_value(value):
+    if value is None:
+        return u''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return unicode(value)
+
+
+class _LineBuffer(object):
+    """ File-like object which hands back what csv.writer writes to it """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """ Yields a header and then one UTF-8 encoded CSV line per row """
+    writer = csv.writer(_LineBuffer())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow([_format_value(row[field]).encode('utf-8')
+                               for field in FIELDS])
+
+
+def jsonl_lines(rows):
+    """ Yields one JSON object per line """
+    for row in rows:
+        data = dict([(field, row[field]) for field in FIELDS])
+        for field in ('date_created', 'date_sent'):
+            data[field] = data[field] and data[field].isoformat()
+        yield json.dumps(data) + '\n'
+
+
+def export_lines(messages, format, chunk_size=1000):
+    """ Yields the lines of an export of messages in the given format """
+    rows = export_rows(messages, chunk_size=chunk_size)
+    if format == 'jsonl':
+        return jsonl_lines(rows)
+    return csv_lines(rows)
@@ -3,13 +3,43 @@
 import datetime
 
 from django import forms
+from django.core.urlresolvers import reverse
 from django.forms.models import modelformset_factory
 from django.utils.dates import MONTHS
+from django.utils.encoding import force_unicode
 
-from broadcast.models import Broadcast, ForwardingRule
+from broadcast.models import Broadcast, BroadcastMessage, ForwardingRule
 from groups.models import Group
 
 
+class AsyncSelectMultiple(forms.SelectMultiple):
+    """
+    Multiple select for a ModelMultipleChoiceField which only renders the
+    selected options. The javascript loads other options on demand from
+    the URL in the widget's data-url attribute.
+    """
+
+    def render_options(self, choices, selected_choices):
+        selected_choices = set([force_unicode(v) for v in selected_choices])
+        pks = [v for v in selected_choices if v.isdigit()]
+        field = self.choices.field
+        output = []
+        for obj in field.queryset.filter(pk__in=pks):
+            output.append(self.render_option(selected_choices, obj.pk,
+                                             field.label_from_instance(obj)))
+        return u'\n'.join(output)
+
+
+def group_select(field, widget_class):
+    """ Switch a groups field to load its options on demand """
+    attrs = {
+        'class': widget_class,
+        'data-url': reverse('broadcast-group-search'),
+    }
+    field.widget = AsyncSelectMultiple(attrs=attrs)
+    field.widget.choices = field.choices
+
+
 class BroadcastForm(forms.ModelForm):
     """ Form to send a broadcast message """
 
@@ -43,7 +73,7 @@ class BroadcastForm(forms.ModelForm):
         self.fields['months'].help_text = ''
         self.fields['months'].widget.attrs['class'] = widget_class
         self.fields['groups'].help_text = ''
-        self.fields['groups'].widget.attrs['class'] = widget_class
+        group_select(self.fields['groups'], widget_class)
         self.fields['body'].widget.attrs['class'] = 'test-messager-field'
         # hide disabled frequency in form
         choices = list(Broadcast.REPEAT_CHOICES)
@@ -82,6 +112,42 @@ class BroadcastForm(forms.ModelForm):
 ForwardingRuleFormset = modelformset_factory(ForwardingRule, can_delete=True)
 
 
+class MessageFilterForm(forms.Form):
+    """ Form to filter the broadcast message history """
+
+    STATUS_CHOICES = (('', 'All'),) + BroadcastMessage.STATUS_CHOICES
+    broadcast = forms.IntegerField(label='Message ID', required=False,
+                                   min_value=1)
+    status = forms.ChoiceField(choices=STATUS_CHOICES, required=False)
+    start_date = forms.DateTimeField(label='Queued after', required=False)
+    end_date = forms.DateTimeField(label='Queued before', required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(MessageFilterForm, self).__init__(*args, **kwargs)
+        picker_class = 'datetimepicker'
+        self.fields['start_date'].widget.attrs['class'] = picker_class
+        self.fields['end_date'].widget.attrs['class'] = picker_class
+
+    def is_filtered(self):
+        return any(self.cleaned_data.values())
+
+    def filter(self, messages):
+        """ Apply the filters to a BroadcastMessage queryset """
+        broadcast = self.cleaned_data.get('broadcast')
+        if broadcast:
+            messages = messages.filter(broadcast=broadcast)
+        status = self.cleaned_data.get('status')
+        if status:
+            messages = messages.filter(status=status)
+        start_date = self.cleaned_data.get('start_date')
+        if start_date:
+            messages = messages.filter(date_created__gte=start_date)
+        end_date = self.cleaned_data.get('end_date')
+        if end_date:
+            messages = messages.filter(date_created__lt=end_date)
+        return messages
+
+
 class ForwardingRuleForm(forms.ModelForm):
 
     class Meta(object):
@@ -97,6 +163,16 @@ class ReportForm(forms.Form):
     )
 
 
+class GraphDataForm(ReportForm):
+    months = forms.IntegerField(label='Months', required=False,
+        min_value=1, max_value=120
+    )
+
+
 class RecentMessageForm(forms.Form):
     groups = forms.ModelMultipleChoiceField(queryset=Group.objects.all())
 
+    def __init__(self, *args, **kwargs):
+        super(RecentMessageForm, self).__init__(*args, **kwargs)
+        group_select(self.fields['groups'], 'multiselect')
+
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from broadcast.app import archive_broadcast_messages
+
+
+class Command(BaseCommand):
+    help = ("Moves old sent, failed and cancelled broadcast messages to the "
+            "archive.")
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', help='Retention period in days, '
+                    'defaults to BROADCAST_ARCHIVE_DAYS'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=500, help='Messages moved per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        count = archive_broadcast_messages(days=options.get('days'),
+                                           batch_size=options['batch_size'])
+        self.stdout.write('Archived {0} message(s)\n'.format(count))
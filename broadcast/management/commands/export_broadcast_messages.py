@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from broadcast.export import FORMATS, export_lines
+from broadcast.forms import MessageFilterForm
+from broadcast.models import ArchivedBroadcastMessage, BroadcastMessage
+
+
+class Command(BaseCommand):
+    help = "Exports broadcast messages as CSV or JSON lines."
+    option_list = BaseCommand.option_list + (
+        make_option('--broadcast', help='Only export this broadcast'),
+        make_option('--status', help='Only export messages with this status'),
+        make_option('--start', dest='start_date',
+                    help='Only export messages queued after this date'),
+        make_option('--end', dest='end_date',
+                    help='Only export messages queued before this date'),
+        make_option('--format', default='csv', choices=FORMATS.keys(),
+                    help='csv (default) or jsonl'),
+        make_option('--output', help='File to write to instead of stdout'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=1000, help='Messages read per query'),
+    )
+
+    def handle(self, *args, **options):
+        data = dict([(name, options.get(name) or '') for name in
+                     ('broadcast', 'status', 'start_date', 'end_date')])
+        form = MessageFilterForm(data)
+        if not form.is_valid():
+            errors = [u'{0}: {1}'.format(name, u' '.join(messages))
+                      for name, messages in form.errors.items()]
+            raise CommandError(u'\n'.join(errors))
+        messages = [form.filter(BroadcastMessage.objects.all()),
+                    form.filter(ArchivedBroadcastMessage.objects.all())]
+        if options.get('output'):
+            output = open(options['output'], 'w')
+        else:
+            output = self.stdout
+        try:
+            for line in export_lines(messages, options['format'],
+                                     chunk_size=options['chunk_size']):
+                output.write(line)
+        finally:
+            if output is not self.stdout:
+                output.close()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from broadcast.receipts import apply_receipts, parse_lines
+
+
+class Command(BaseCommand):
+    args = '[file ...]'
+    help = ("Applies delivery receipts, given as JSON lines of "
+            "{\"id\": ..., \"status\": ...} objects, read from the given "
+            "files or stdin.")
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=500, help='Receipts applied per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        totals = {'delivered': 0, 'undelivered': 0, 'ignored': 0}
+        for path in args or ['-']:
+            if path == '-':
+                lines = sys.stdin
+            else:
+                try:
+                    lines = open(path)
+                except IOError, e:
+                    raise CommandError(unicode(e))
+            try:
+                counts = apply_receipts(parse_lines(lines),
+                                        chunk_size=options['chunk_size'])
+            except ValueError, e:
+                raise CommandError(u'{0}: {1}'.format(path, e))
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+            for key, count in counts.items():
+                totals[key] += count
+        self.stdout.write('{delivered} delivered, {undelivered} undelivered, '
+                          '{ignored} ignored\n'.format(**totals))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from broadcast.app import build_usage_report, last_month, send_usage_report
+from broadcast.models import UsageReport
+
+
+class Command(BaseCommand):
+    help = "Sends, or re-sends, the stored usage report of a past month."
+    option_list = BaseCommand.option_list + (
+        make_option('--month', help='YYYY-MM, defaults to last month'),
+        make_option('--rebuild', action='store_true', default=False,
+                    help='Rebuild the report before sending it'),
+        make_option('--no-email', dest='email', action='store_false',
+                    default=True, help='Only build the report'),
+    )
+
+    def handle(self, *args, **options):
+        if options.get('month'):
+            try:
+                month = datetime.datetime.strptime(options['month'], '%Y-%m')
+            except ValueError:
+                raise CommandError('--month must be given as YYYY-MM')
+            month = month.date()
+            if month > last_month():
+                raise CommandError('Only past months can be reported')
+        else:
+            month = last_month()
+        try:
+            report = UsageReport.objects.get(month=month)
+        except UsageReport.DoesNotExist:
+            report = None
+        if report is None or options['rebuild']:
+            report = build_usage_report(month)
+        if options['email']:
+            send_usage_report(report)
+            self.stdout.write('Sent {0}\n'.format(report))
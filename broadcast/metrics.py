@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Operational metrics of the broadcast pipeline.
+
+Counters are updated in Django's cache by the code paths that queue and
+send messages, so reading them never needs to count database rows. Use a
+cache backend shared by all processes, such as memcached, to aggregate
+metrics across them; counters restart from zero if the cache is cleared.
+
+BROADCAST_METRICS_HOOK may name a function which is called with
+(kind, name, value, labels) on every update, to forward metrics to another
+system such as statsd.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.importlib import import_module
+
+from broadcast.caching import FOREVER
+
+
+logger = logging.getLogger('broadcast.metrics')
+
+PREFIX = 'broadcast:metrics'
+
+# Stages of a scheduler tick, timed by scheduler_callback
+STAGES = ('queue', 'send')
+
+# Upper bounds of the fan-out size (recipients per broadcast) histogram
+FANOUT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+_hook = None
+
+
+def _key(name, labels):
+    parts = [u'{0}={1}'.format(k, v) for k, v in sorted(labels.items())]
+    return u'{0}:{1}:{2}'.format(PREFIX, name, u','.join(parts))
+
+
+def _call_hook(kind, name, value, labels):
+    global _hook
+    path = getattr(settings, 'BROADCAST_METRICS_HOOK', None)
+    if not path:
+        return
+    if _hook is None:
+        module, attr = path.rsplit('.', 1)
+        _hook = getattr(import_module(module), attr)
+    try:
+        _hook(kind, name, value, labels)
+    except Exception, e:
+        logger.exception(e)
+
+
+def incr(name, value=1, **labels):
+    """ Add value to an integer counter """
+    key = _key(name, labels)
+    try:
+        cache.incr(key, value)
+    except ValueError:
+        if not cache.add(key, value, FOREVER):
+            cache.incr(key, value)
+    _call_hook('counter', name, value, labels)
+
+
+def set_gauge(name, value, **labels):
+    """ Set a value which can go up and down """
+    cache.set(_key(name, labels), value, FOREVER)
+    _call_hook('gauge', name, value, labels)
+
+
+def get(name, **labels):
+    return cache.get(_key(name, labels)) or 0
+
+
+def observe_fanout(size):
+    """ Count a broadcast queued to size recipients """
+    for bound in FANOUT_BUCKETS:
+        if size <= bound:
+            incr('fanout_bucket', le=bound)
+            break
+    else:
+        incr('fanout_bucket', le='+Inf')
+    incr('fanout_sum', size)
+    incr('fanout_count')
+
+
+@contextmanager
+def timed(stage):
+    """ Record the duration of a stage of the scheduler tick """
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        set_gauge('stage_last_seconds', duration, stage=stage)
+        incr('stage_milliseconds', int(duration * 1000), stage=stage)
+        incr('stage_runs', stage=stage)
+
+
+def render(backends):
+    """
+    Returns all metrics in the Prometheus text exposition format. backends
+    maps the ids of the backends to report on to their names.
+    """
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP broadcast_{0} {1}'.format(name, help))
+        lines.append('# TYPE broadcast_{0} {1}'.format(name, kind))
+        for labels, value in samples:
+            if labels:
+                labels = u'{{{0}}}'.format(u','.join(
+                    [u'{0}="{1}"'.format(k, v) for k, v in labels]))
+            lines.append(u'broadcast_{0}{1} {2}'.format(name, labels or u'',
+                                                        value))
+
+    metric('queue_depth', 'gauge', 'Messages waiting to be sent.',
+           [((), get('queue_depth'))])
+    oldest = get('oldest_queued_timestamp')
+    metric('oldest_queued_age_seconds', 'gauge',
+           'Age of the oldest queued message at the last scheduler tick.',
+           [((), oldest and max(time.time() - oldest, 0) or 0)])
+    metric('messages_queued_total', 'counter', 'Messages queued.',
+           [((), get('queued'))])
+    for status, help in (('sent', 'sent'), ('errors', 'which failed to send'),
+                         ('retries', 'queued again after a failure')):
+        samples = [((('backend', backends.get(pk, pk)),),
+                    get(status, backend=pk)) for pk in sorted(backends)]
+        samples.append(((('backend', 'none'),), get(status, backend='none')))
+        metric('messages_{0}_total'.format(status), 'counter',
+               'Messages {0} per backend.'.format(help), samples)
+    metric('messages_suppressed_total', 'counter',
+           'Recipients skipped as duplicates of a recent message.',
+           [((), get('suppressed'))])
+    metric('messages_delivered_total', 'counter',
+           'Messages confirmed delivered by a receipt.',
+           [((), get('delivered'))])
+    metric('messages_undelivered_total', 'counter',
+           'Messages reported undelivered by a receipt.',
+           [((), get('undelivered'))])
+    lines.append('# HELP broadcast_fanout_size Recipients per queued '
+                 'broadcast.')
+    lines.append('# TYPE broadcast_fanout_size histogram')
+    cumulative = 0
+    for bound in FANOUT_BUCKETS + ('+Inf',):
+        cumulative += get('fanout_bucket', le=bound)
+        lines.append(u'broadcast_fanout_size_bucket{{le="{0}"}} {1}'.format(
+            bound, cumulative))
+    lines.append(u'broadcast_fanout_size_sum {0}'.format(get('fanout_sum')))
+    lines.append(u'broadcast_fanout_size_count {0}'.format(
+        get('fanout_count')))
+    metric('stage_last_duration_seconds', 'gauge',
+           'Duration of the last run of a scheduler tick stage.',
+           [((('stage', s),), get('stage_last_seconds', stage=s))
+            for s in STAGES])
+    metric('stage_duration_seconds_total', 'counter',
+           'Time spent in a scheduler tick stage.',
+           [((('stage', s),), get('stage_milliseconds', stage=s) / 1000.0)
+            for s in STAGES])
+    metric('stage_runs_total', 'counter',
+           'Runs of a scheduler tick stage.',
+           [((('stage', s),), get('stage_runs', stage=s)) for s in STAGES])
+    return u'\n'.join(lines) + u'\n'
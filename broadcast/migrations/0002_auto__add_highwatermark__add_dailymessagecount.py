@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'HighWaterMark'
+        db.create_table('broadcast_highwatermark', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(unique=True, max_length=64)),
+            ('last_id', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('date_updated', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('broadcast', ['HighWaterMark'])
+
+        # Adding model 'DailyMessageCount'
+        db.create_table('broadcast_dailymessagecount', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('date', self.gf('django.db.models.fields.DateField')(db_index=True)),
+            ('direction', self.gf('django.db.models.fields.CharField')(max_length=1)),
+            ('source', self.gf('django.db.models.fields.CharField')(max_length=16)),
+            ('backend', self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='daily_message_counts', null=True, on_delete=models.SET_NULL, to=orm['rapidsms.Backend'])),
+            ('rule', self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='daily_message_counts', null=True, on_delete=models.SET_NULL, to=orm['broadcast.ForwardingRule'])),
+            ('broadcast', self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='daily_message_counts', null=True, on_delete=models.SET_NULL, to=orm['broadcast.Broadcast'])),
+            ('count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+        ))
+        db.send_create_signal('broadcast', ['DailyMessageCount'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'HighWaterMark'
+        db.delete_table('broadcast_highwatermark')
+
+        # Deleting model 'DailyMessageCount'
+        db.delete_table('broadcast_dailymessagecount')
+
+
+    models = {
+        'broadcast.broadcast': {
+            'Meta': {'object_name': 'Broadcast'},
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {}),
+            'date_last_notified': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'forward': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'broadcasts'", 'null': 'True', 'to': "orm['broadcast.ForwardingRule']"}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'broadcasts'", 'symmetrical': 'False', 'to': "orm['groups.Group']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'months': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'broadcast_months'", 'blank': 'True', 'to': "orm['broadcast.DateAttribute']"}),
+            'schedule_end_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'schedule_frequency': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '16', 'null': 'True', 'blank': 'True'}),
+            'weekdays': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'broadcast_weekdays'", 'blank': 'True', 'to': "orm['broadcast.DateAttribute']"})
+        },
+        'broadcast.broadcastmessage': {
+            'Meta': {'object_name': 'BroadcastMessage'},
+            'broadcast': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'messages'", 'to': "orm['broadcast.Broadcast']"}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {}),
+            'date_sent': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'recipient': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'broadcast_messages'", 'to': "orm['rapidsms.Contact']"}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'queued'", 'max_length': '16', 'db_index': 'True'})
+        },
+        'broadcast.dailymessagecount': {
+            'Meta': {'ordering': "('-date',)", 'object_name': 'DailyMessageCount'},
+            'backend': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'daily_message_counts'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': "orm['rapidsms.Backend']"}),
+            'broadcast': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'daily_message_counts'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': "orm['broadcast.Broadcast']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'direction': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'rule': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'daily_message_counts'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': "orm['broadcast.ForwardingRule']"}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '16'})
+        },
+        'broadcast.dateattribute': {
+            'Meta': {'ordering': "('value',)", 'unique_together': "(('type', 'value'),)", 'object_name': 'DateAttribute'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '32'}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'value': ('django.db.models.fields.PositiveSmallIntegerField', [], {})
+        },
+        'broadcast.forwardingrule': {
+            'Meta': {'object_name': 'ForwardingRule'},
+            'dest': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dest_rules'", 'to': "orm['groups.Group']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'keyword': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '160'}),
+            'label': ('django.db.models.fields.CharField', [], {'max_length': '150', 'null': 'True', 'blank': 'True'}),
+            'message': ('django.db.models.fields.CharField', [], {'max_length': '160', 'blank': 'True'}),
+            'rule_type': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'source_rules'", 'to': "orm['groups.Group']"})
+        },
+        'broadcast.highwatermark': {
+            'Meta': {'object_name': 'HighWaterMark'},
+            'date_updated': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_id': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'})
+        },
+        'groups.group': {
+            'Meta': {'object_name': 'Group'},
+            'contacts': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'groups'", 'blank': 'True', 'to': "orm['rapidsms.Contact']"}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_editable': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'})
+        },
+        'rapidsms.backend': {
+            'Meta': {'object_name': 'Backend'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '20'})
+        },
+        'rapidsms.contact': {
+            'Meta': {'object_name': 'Contact'},
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.CharField', [], {'max_length': '6', 'blank': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'phone': ('django.db.models.fields.CharField', [], {'max_length': '32', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['broadcast']
@@ -1,15 +1,30 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+from array import array
+import base64
+import datetime
 from dateutil import rrule
+import hashlib
 import logging
+import sys
+import zlib
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+    pre_delete)
+from django.dispatch import receiver
+from django.utils import simplejson as json
 from django.utils import timezone
 
-from rapidsms.models import Contact
+from rapidsms.models import Backend, Connection, Contact
 
 from groups.models import Group
 
+from broadcast import caching, metrics
+
 
 logger = logging.getLogger('broadcast.models')
 
@@ -162,11 +177,64 @@ class Broadcast(models.Model):
         logger.debug('set_next_date end - {0}'.format(self))
 
     def queue_outgoing_messages(self):
-        """ generate queued outgoing messages """
+        """
+        generate queued outgoing messages, or a single recipient snapshot
+        if BROADCAST_COMPACT_RECIPIENTS is on. With
+        BROADCAST_SUPPRESSION_SECONDS set, contacts who were sent the same
+        body within that many seconds are skipped.
+        """
         contacts = Contact.objects.distinct().filter(groups__broadcasts=self)
-        for contact in contacts:
-            self.messages.create(recipient=contact)
-        return contacts.count()
+        digest = body_hash(self.body)
+        contact_ids = list(contacts.values_list('pk', flat=True))
+        window = getattr(settings, 'BROADCAST_SUPPRESSION_SECONDS', None)
+        suppressed = 0
+        if window:
+            recent = recently_sent(digest, window)
+            suppressed = len(contact_ids)
+            contact_ids = [pk for pk in contact_ids if pk not in recent]
+            suppressed -= len(contact_ids)
+            if suppressed:
+                logger.info(u'Suppressed {0} duplicate(s) of broadcast '
+                            u'{1}'.format(suppressed, self.pk))
+                metrics.incr('suppressed', suppressed)
+        unreachable = 0
+        if getattr(settings, 'BROADCAST_COMPACT_RECIPIENTS', False):
+            snapshot = RecipientSnapshot(broadcast=self, body_hash=digest)
+            snapshot.set_recipients(contact_ids)
+            snapshot.save()
+            count = snapshot.size
+        else:
+            # bind each message to its recipient's connection now, so the
+            # sender doesn't look them up one by one
+            connections = preferred_connections(contacts)
+            now = timezone.now()
+            messages = []
+            for contact_id in contact_ids:
+                connection = connections.get(contact_id)
+                messages.append(BroadcastMessage(
+                    broadcast=self, recipient_id=contact_id,
+                    connection=connection, body_hash=digest,
+                    date_created=now,
+                    status=connection and 'queued' or 'unreachable'))
+            # Django 1.4's bulk_create has no batch_size
+            for start in range(0, len(messages), 500):
+                BroadcastMessage.objects.bulk_create(
+                    messages[start:start + 500])
+            count = len([m for m in messages if m.connection])
+            unreachable = len(messages) - count
+            if unreachable:
+                logger.warning(u'{0} recipient(s) of broadcast {1} have no '
+                               u'connection'.format(unreachable, self.pk))
+                metrics.incr('errors', unreachable, backend='none')
+        BroadcastStats.objects.add_queued(self.pk, count, suppressed,
+                                          unreachable)
+        metrics.incr('queued', count)
+        metrics.observe_fanout(count)
+        return count
+
+    def recipient_count(self):
+        """ Number of contacts this broadcast will be sent to """
+        return recipient_count([group.pk for group in self.groups.all()])
 
     def save(self, **kwargs):
         if not self.pk:
@@ -174,21 +242,196 @@ class Broadcast(models.Model):
         return super(Broadcast, self).save(**kwargs)
 
 
+class BroadcastMessageManager(models.Manager):
+
+    # (upper bound in seconds, label) of the backlog age buckets
+    AGE_BUCKETS = (
+        (5 * 60, '< 5 minutes'),
+        (60 * 60, '< 1 hour'),
+        (6 * 60 * 60, '< 6 hours'),
+        (24 * 60 * 60, '< 1 day'),
+        (None, 'older'),
+    )
+
+    def backlog(self):
+        """
+        Queued messages counted by broadcast and age, and by backend. Uses
+        one grouped query per age bucket on the (status, date_created)
+        index, so the cost doesn't depend on the number of sent messages.
+        Unsent recipients of compact mode snapshots are counted by
+        broadcast only.
+        """
+        now = timezone.now()
+        queued = self.filter(status='queued')
+        by_broadcast = {}
+        lower = 0
+        for index, (upper, label) in enumerate(self.AGE_BUCKETS):
+            bucket = queued.filter(date_created__lte=now -
+                                   datetime.timedelta(seconds=lower))
+            if upper is not None:
+                bucket = bucket.filter(date_created__gt=now -
+                                       datetime.timedelta(seconds=upper))
+            counts = bucket.values_list('broadcast').annotate(
+                count=Count('id')).order_by()
+            for broadcast_id, count in counts:
+                row = by_broadcast.setdefault(
+                    broadcast_id, [0] * len(self.AGE_BUCKETS))
+                row[index] = count
+            lower = upper
+        # recipients of compact mode snapshots, which have no backend until
+        # they are sent to
+        snapshots = RecipientSnapshot.objects.pending().values_list(
+            'broadcast', 'date_created', 'size', 'position')
+        for broadcast_id, date_created, size, position in snapshots:
+            age = now - date_created
+            seconds = age.days * 86400 + age.seconds
+            for index, (upper, label) in enumerate(self.AGE_BUCKETS):
+                if upper is None or seconds < upper:
+                    break
+            row = by_broadcast.setdefault(
+                broadcast_id, [0] * len(self.AGE_BUCKETS))
+            row[index] += size - position
+        broadcasts = Broadcast.objects.in_bulk(by_broadcast.keys())
+        rows = []
+        for broadcast_id, counts in sorted(by_broadcast.items()):
+            rows.append({
+                'broadcast': broadcasts.get(broadcast_id),
+                'broadcast_id': broadcast_id,
+                'counts': counts,
+                'total': sum(counts),
+            })
+        backends = queued.values_list('connection__backend__name').annotate(
+            count=Count('id')).order_by()
+        return {
+            'buckets': [label for upper, label in self.AGE_BUCKETS],
+            'broadcasts': rows,
+            'backends': [(name or 'none', count) for name, count in backends],
+            'total': sum([row['total'] for row in rows]),
+        }
+
+    def _change_status(self, messages, old, new, **fields):
+        messages = messages.filter(status=old)
+        counts = messages.values_list('broadcast').annotate(
+            count=Count('id')).order_by()
+        with transaction.commit_on_success():
+            counts = list(counts)
+            messages.update(status=new, **fields)
+            for broadcast_id, count in counts:
+                BroadcastStats.objects._move(broadcast_id, old, new, count)
+        return sum([count for broadcast_id, count in counts])
+
+    def requeue(self, messages):
+        """ Queue failed messages of a queryset again """
+        return self._change_status(messages, 'error', 'queued', attempts=0,
+                                   next_attempt=None)
+
+    def cancel(self, messages):
+        """ Cancel queued messages of a queryset """
+        return self._change_status(messages, 'queued', 'cancelled')
+
+    def claim(self, limit, worker, lease_seconds=None):
+        """
+        Lease up to limit queued messages, and messages whose lease has
+        expired, to worker by moving them to the 'sending' status. Fresh
+        messages are claimed first, then retries which are due. Each
+        message is leased to a single worker: the update only applies to
+        rows which are still unclaimed, so concurrent claims of the same
+        rows are lost by all but one of them. With BROADCAST_SKIP_LOCKED
+        on (PostgreSQL 9.5+), candidates locked by another claim are
+        skipped instead of waited for. Returns the claimed messages.
+        """
+        if lease_seconds is None:
+            lease_seconds = getattr(settings, 'BROADCAST_LEASE_SECONDS', 300)
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds=lease_seconds)
+        fresh = Q(status='queued', next_attempt__isnull=True) | \
+            Q(status='sending', lease_expires__lt=now)
+        retries = Q(status='queued', next_attempt__lte=now)
+        with transaction.commit_on_success():
+            ids = self._candidates(self.filter(fresh), limit)
+            if len(ids) < limit:
+                ids += self._candidates(self.filter(retries),
+                                        limit - len(ids))
+            self.filter(fresh | retries, pk__in=ids).update(
+                status='sending', worker=worker, lease_expires=expires)
+        claimed = self.filter(pk__in=ids, status='sending', worker=worker,
+                              lease_expires=expires)
+        # the router reads the contact of each connection
+        claimed = claimed.select_related('broadcast', 'connection__backend',
+                                         'connection__contact')
+        return list(claimed.order_by('pk'))
+
+    def _candidates(self, messages, limit):
+        candidates = messages.order_by('pk').values_list('pk', flat=True)
+        candidates = candidates[:limit]
+        if getattr(settings, 'BROADCAST_SKIP_LOCKED', False):
+            sql, params = candidates.query.sql_with_params()
+            cursor = connection.cursor()
+            cursor.execute(sql + ' FOR UPDATE SKIP LOCKED', params)
+            return [row[0] for row in cursor.fetchall()]
+        return list(candidates)
+
+
 class BroadcastMessage(models.Model):
     """ Message to individual recipient of broadcast """
 
     STATUS_CHOICES = (
         ('queued', 'Queued'),
+        ('sending', 'Sending'),
         ('sent', 'Sent'),
         ('error', 'Error'),
+        ('cancelled', 'Cancelled'),
+        ('unreachable', 'No connection'),
+        ('delivered', 'Delivered'),
+        ('undelivered', 'Not delivered'),
     )
 
     broadcast = models.ForeignKey(Broadcast, related_name='messages')
     recipient = models.ForeignKey(Contact, related_name='broadcast_messages')
-    date_created = models.DateTimeField()
+    # the recipient's connection when the message was queued
+    connection = models.ForeignKey(Connection, null=True, blank=True,
+                                   related_name='broadcast_messages',
+                                   on_delete=models.SET_NULL)
+    date_created = models.DateTimeField(db_index=True)
     date_sent = models.DateTimeField(null=True, blank=True, db_index=True)
+    # also indexed together with date_created, see migration 0007
     status = models.CharField(max_length=16, choices=STATUS_CHOICES,
                               default='queued', db_index=True)
+    # sender which leased the message, and until when
+    worker = models.CharField(max_length=64, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # SHA-1 of the broadcast body, indexed together with date_created to
+    # find duplicates, see migration 0014
+    body_hash = models.CharField(max_length=40, blank=True)
+    # id of the sent message, to match delivery receipts
+    external_id = models.CharField(max_length=64, blank=True, db_index=True)
+    date_delivered = models.DateTimeField(null=True, blank=True)
+    # attempts to send so far, and when to retry a failed one
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = BroadcastMessageManager()
+
+    def failed(self, now, transient=True):
+        """
+        Record a failed attempt. Transient failures are queued again after
+        BROADCAST_RETRY_SECONDS (60 by default), doubling with each attempt
+        up to BROADCAST_RETRY_MAX_SECONDS (an hour), until
+        BROADCAST_MAX_ATTEMPTS (5) attempts have been made. Returns whether
+        the message will be retried.
+        """
+        self.attempts += 1
+        max_attempts = getattr(settings, 'BROADCAST_MAX_ATTEMPTS', 5)
+        if not transient or self.attempts >= max_attempts:
+            self.status = 'error'
+            self.next_attempt = None
+            return False
+        delay = getattr(settings, 'BROADCAST_RETRY_SECONDS', 60)
+        delay = min(delay * 2 ** (self.attempts - 1),
+                    getattr(settings, 'BROADCAST_RETRY_MAX_SECONDS', 3600))
+        self.status = 'queued'
+        self.next_attempt = now + datetime.timedelta(seconds=delay)
+        return True
 
     def save(self, **kwargs):
         if not self.pk:
@@ -196,6 +439,340 @@ class BroadcastMessage(models.Model):
         return super(BroadcastMessage, self).save(**kwargs)
 
 
+class ArchivedBroadcastMessage(models.Model):
+    """
+    Sent, failed or cancelled BroadcastMessage moved out of the hot table
+    once it is older than the retention period. Keeps the original id, so
+    history can be read from both tables in id order.
+    """
+
+    ARCHIVED_STATUSES = ('sent', 'error', 'cancelled', 'unreachable',
+                         'delivered', 'undelivered')
+
+    id = models.PositiveIntegerField(primary_key=True)
+    broadcast = models.ForeignKey(Broadcast, related_name='archived_messages')
+    recipient = models.ForeignKey(Contact,
+                                  related_name='archived_broadcast_messages')
+    connection = models.ForeignKey(Connection, null=True, blank=True,
+                                   related_name='archived_broadcast_messages',
+                                   on_delete=models.SET_NULL)
+    date_created = models.DateTimeField(db_index=True)
+    date_sent = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=16,
+                              choices=BroadcastMessage.STATUS_CHOICES)
+    external_id = models.CharField(max_length=64, blank=True, db_index=True)
+    date_delivered = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+
+class RecipientSnapshotManager(models.Manager):
+
+    def pending(self):
+        """ Snapshots with recipients left to send to """
+        return self.filter(position__lt=F('size'))
+
+    def claim(self, limit, worker, lease_seconds=None):
+        """
+        Take up to limit recipients, in snapshot order, off the pending
+        snapshots, leased to worker for lease_seconds
+        (BROADCAST_LEASE_SECONDS, 300 by default). Returns a list of
+        RecipientClaims, which the worker deletes once it has sent to their
+        recipients. Claims whose lease expired, because their worker died,
+        are taken over first, so their recipients are never lost, although
+        some of them may be sent to twice.
+        """
+        if lease_seconds is None:
+            lease_seconds = getattr(settings, 'BROADCAST_LEASE_SECONDS', 300)
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds=lease_seconds)
+        claimed = []
+        expired = RecipientClaim.objects.filter(lease_expires__lt=now)
+        for claim in expired.select_related('snapshot__broadcast').order_by(
+          'pk'):
+            if limit <= 0:
+                break
+            # lost to a concurrent sender if it took the claim meanwhile
+            taken = RecipientClaim.objects.filter(
+                pk=claim.pk, worker=claim.worker,
+                lease_expires=claim.lease_expires,
+            ).update(worker=worker, lease_expires=expires)
+            if not taken:
+                continue
+            claim.worker, claim.lease_expires = worker, expires
+            limit -= claim.end - claim.start
+            claimed.append(claim)
+        for snapshot in self.pending().select_related('broadcast'):
+            if limit <= 0:
+                break
+            start = snapshot.position
+            end = min(start + limit, snapshot.size)
+            with transaction.commit_on_success():
+                # lost to a concurrent sender if the position moved meanwhile
+                moved = self.filter(pk=snapshot.pk, position=start).update(
+                    position=end)
+                if moved:
+                    snapshot.position = end
+                    claimed.append(RecipientClaim.objects.create(
+                        snapshot=snapshot, start=start, end=end,
+                        worker=worker, lease_expires=expires))
+                    limit -= end - start
+        return claimed
+
+    def cancel(self, broadcasts):
+        """
+        Cancel the recipients not yet sent to of the given broadcasts,
+        including those of expired claims. Returns the number of recipients
+        cancelled.
+        """
+        cancelled = 0
+        with transaction.commit_on_success():
+            snapshots = self.pending().filter(broadcast__in=broadcasts)
+            for snapshot in snapshots.select_for_update():
+                count = snapshot.size - snapshot.position
+                snapshot.position = snapshot.size
+                snapshot.save()
+                BroadcastStats.objects._move(snapshot.broadcast_id, 'queued',
+                                             'cancelled', count)
+                cancelled += count
+            expired = RecipientClaim.objects.select_related('snapshot').filter(
+                snapshot__broadcast__in=broadcasts,
+                lease_expires__lt=timezone.now())
+            for claim in expired.select_for_update():
+                count = claim.end - claim.start
+                claim.delete()
+                BroadcastStats.objects._move(claim.snapshot.broadcast_id,
+                                             'queued', 'cancelled', count)
+                cancelled += count
+        return cancelled
+
+
+class RecipientSnapshot(models.Model):
+    """
+    Recipients of one run of a broadcast in compact mode, stored as a
+    packed array of contact ids instead of one BroadcastMessage each. The
+    recipients are sent to in order: those before position have been
+    claimed by a sender, see RecipientClaim, and only the ones which failed
+    get a BroadcastMessage: queued to be retried like any other message, or
+    'unreachable' if they have no connection.
+    """
+
+    broadcast = models.ForeignKey(Broadcast,
+                                  related_name='recipient_snapshots')
+    date_created = models.DateTimeField(db_index=True)
+    body_hash = models.CharField(max_length=40, blank=True, db_index=True)
+    # sorted contact ids, delta encoded, zlib compressed and base64 encoded
+    recipients = models.TextField(blank=True)
+    size = models.PositiveIntegerField(default=0)
+    position = models.PositiveIntegerField(default=0)
+    # BroadcastMessages created for recipients which failed
+    exception_rows = models.PositiveIntegerField(default=0)
+
+    objects = RecipientSnapshotManager()
+
+    def __unicode__(self):
+        return u'{0}: {1} of {2} recipients sent'.format(
+            self.broadcast_id, self.position, self.size)
+
+    def get_recipients(self):
+        """ Returns the array of contact ids """
+        if not self.recipients:
+            return array('I')
+        ids = array('I')
+        ids.fromstring(zlib.decompress(base64.b64decode(self.recipients)))
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        total = 0
+        for index, delta in enumerate(ids):
+            total += delta
+            ids[index] = total
+        return ids
+
+    def set_recipients(self, contact_ids):
+        ids = array('I', sorted(set(contact_ids)))
+        self.size = len(ids)
+        previous = 0
+        for index, contact_id in enumerate(ids):
+            ids[index], previous = contact_id - previous, contact_id
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        self.recipients = base64.b64encode(zlib.compress(ids.tostring()))
+
+    def save(self, **kwargs):
+        if not self.pk:
+            self.date_created = timezone.now()
+        return super(RecipientSnapshot, self).save(**kwargs)
+
+
+class RecipientClaim(models.Model):
+    """
+    Recipients of a snapshot, from start up to end, which a sender is
+    sending to until its lease expires
+    """
+
+    snapshot = models.ForeignKey(RecipientSnapshot, related_name='claims')
+    start = models.PositiveIntegerField()
+    end = models.PositiveIntegerField()
+    worker = models.CharField(max_length=64)
+    lease_expires = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return u'{0}: recipients {1} to {2} leased to {3}'.format(
+            self.snapshot_id, self.start, self.end, self.worker)
+
+    def get_recipients(self):
+        """ Returns the array of claimed contact ids """
+        return self.snapshot.get_recipients()[self.start:self.end]
+
+
+class BroadcastStatsManager(models.Manager):
+
+    def _get_for_update(self, broadcast_id):
+        self.get_or_create(broadcast_id=broadcast_id)
+        return self.select_for_update().get(broadcast=broadcast_id)
+
+    def add_queued(self, broadcast_id, count, suppressed=0, errors=0):
+        """
+        Record count newly queued messages, suppressed duplicates and
+        recipients which failed without being queued
+        """
+        with transaction.commit_on_success():
+            stats = self._get_for_update(broadcast_id)
+            stats.queued += count
+            stats.suppressed += suppressed
+            stats.errors += errors
+            stats.save()
+
+    def move(self, broadcast_id, old, new, count):
+        """ Record count messages changing from status old to new """
+        with transaction.commit_on_success():
+            self._move(broadcast_id, old, new, count)
+
+    def _move(self, broadcast_id, old, new, count):
+        """
+        move() within the caller's transaction. A nested commit_on_success
+        would commit on exit and release the caller's row locks.
+        """
+        fields = {'queued': 'queued', 'sent': 'sent', 'error': 'errors'}
+        stats = self._get_for_update(broadcast_id)
+        if old in fields:
+            value = getattr(stats, fields[old])
+            setattr(stats, fields[old], max(value - count, 0))
+        if new in fields:
+            value = getattr(stats, fields[new])
+            setattr(stats, fields[new], value + count)
+        stats.save()
+
+    def add_results(self, broadcast_id, sent, errors):
+        """
+        Record the results of a batch of messages of one broadcast. sent is
+        a list of (date_created, date_sent) pairs of the sent messages,
+        errors the number of messages which failed.
+        """
+        with transaction.commit_on_success():
+            stats = self._get_for_update(broadcast_id)
+            stats.queued = max(stats.queued - len(sent) - errors, 0)
+            stats.sent += len(sent)
+            stats.errors += errors
+            histogram = stats.get_histogram()
+            for date_created, date_sent in sent:
+                if not stats.date_first_sent or \
+                  date_sent < stats.date_first_sent:
+                    stats.date_first_sent = date_sent
+                if not stats.date_last_sent or \
+                  date_sent > stats.date_last_sent:
+                    stats.date_last_sent = date_sent
+                latency = date_sent - date_created
+                seconds = latency.days * 86400 + latency.seconds
+                histogram[stats.bucket(seconds)] += 1
+            stats.set_histogram(histogram)
+            stats.save()
+
+
+class BroadcastStats(models.Model):
+    """
+    Delivery counters of a broadcast, updated by the sender after each
+    batch so progress can be followed without counting messages. Times
+    from queueing to sending are kept as a histogram.
+    """
+
+    # Upper bounds, in seconds, of the latency histogram buckets. One more
+    # bucket holds all longer latencies.
+    LATENCY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 10800,
+                       21600, 43200, 86400)
+
+    broadcast = models.OneToOneField(Broadcast, related_name='stats')
+    queued = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    # recipients skipped because they were sent the same body recently
+    suppressed = models.PositiveIntegerField(default=0)
+    date_first_sent = models.DateTimeField(null=True, blank=True)
+    date_last_sent = models.DateTimeField(null=True, blank=True)
+    latency_histogram = models.CommaSeparatedIntegerField(max_length=255,
+                                                          blank=True)
+
+    objects = BroadcastStatsManager()
+
+    class Meta(object):
+        verbose_name_plural = 'broadcast stats'
+
+    def __unicode__(self):
+        return u'{0}: {1} queued, {2} sent, {3} errors'.format(
+            self.broadcast_id, self.queued, self.sent, self.errors)
+
+    def bucket(self, seconds):
+        """ Index of the histogram bucket of a latency """
+        for index, bound in enumerate(self.LATENCY_BUCKETS):
+            if seconds <= bound:
+                return index
+        return len(self.LATENCY_BUCKETS)
+
+    def get_histogram(self):
+        counts = [int(c) for c in self.latency_histogram.split(',') if c]
+        size = len(self.LATENCY_BUCKETS) + 1
+        return (counts + [0] * size)[:size]
+
+    def set_histogram(self, counts):
+        self.latency_histogram = u','.join([str(c) for c in counts])
+
+    def latency_percentile(self, pct):
+        """
+        Upper bound, in seconds, of the bucket holding the given percentile
+        of queue-to-send latencies. None if nothing was sent or the
+        percentile falls in the unbounded bucket.
+        """
+        histogram = self.get_histogram()
+        total = sum(histogram)
+        if not total:
+            return None
+        rank = pct / 100.0 * total
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if seen >= rank and count:
+                if index < len(self.LATENCY_BUCKETS):
+                    return self.LATENCY_BUCKETS[index]
+                return None
+
+    def as_dict(self):
+        dates = [self.date_first_sent, self.date_last_sent]
+        dates = [d and d.isoformat() or None for d in dates]
+        return {
+            'broadcast': self.broadcast_id,
+            'queued': self.queued,
+            'sent': self.sent,
+            'errors': self.errors,
+            'suppressed': self.suppressed,
+            'first_sent': dates[0],
+            'last_sent': dates[1],
+            'latency': {
+                'p50': self.latency_percentile(50),
+                'p90': self.latency_percentile(90),
+                'p99': self.latency_percentile(99),
+            },
+        }
+
+
 class ForwardingRule(models.Model):
     """ Rule for forwarding SMSes from a user in one group to a 2nd group """
 
@@ -217,3 +794,348 @@ class ForwardingRule(models.Model):
 
     def __unicode__(self):
         return self.keyword
+
+
+@receiver(post_save, sender=ForwardingRule)
+@receiver(post_delete, sender=ForwardingRule)
+def invalidate_reports(sender, **kwargs):
+    """ Rule types and labels are part of the cached usage reports """
+    caching.bump_version('report')
+
+
+def body_hash(body):
+    """ Digest of a message body, to find duplicates """
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def recently_sent(digest, seconds):
+    """
+    Ids of the contacts who were sent, or are about to be sent, a message
+    with the given body hash in the last seconds.
+    """
+    since = timezone.now() - datetime.timedelta(seconds=seconds)
+    contacts = set(BroadcastMessage.objects.filter(
+        body_hash=digest, date_created__gte=since,
+        status__in=('queued', 'sending', 'sent', 'delivered'),
+    ).values_list('recipient', flat=True))
+    snapshots = RecipientSnapshot.objects.filter(body_hash=digest,
+                                                 date_created__gte=since)
+    for snapshot in snapshots:
+        contacts.update(snapshot.get_recipients())
+    return contacts
+
+
+def preferred_connections(contacts):
+    """
+    Maps contact ids to their preferred connection, the first one as in
+    Contact.default_connection, with a single query. contacts is a list of
+    ids or a Contact queryset.
+    """
+    connections = Connection.objects.filter(contact__in=contacts)
+    connections = connections.select_related('backend', 'contact')
+    connections = connections.order_by('-pk')
+    return dict([(c.contact_id, c) for c in connections])
+
+
+def recipient_count(group_ids):
+    """
+    Number of distinct contacts in the given groups. Counts are cached
+    until the membership of one of the groups changes.
+    """
+    group_ids = sorted(set([int(pk) for pk in group_ids]))
+    if not group_ids:
+        return 0
+    versions = caching.get_versions([_recipients_version(pk)
+                                     for pk in group_ids])
+    digest = hashlib.md5(','.join([
+        '{0}:{1}'.format(pk, versions[_recipients_version(pk)])
+        for pk in group_ids])).hexdigest()
+    key = 'broadcast:recipients:{0}'.format(digest)
+    contacts = Contact.objects.filter(groups__in=group_ids).distinct()
+    return caching.get_or_compute(key, contacts.count, caching.FOREVER)
+
+
+def _recipients_version(group_id):
+    return 'recipients:{0}'.format(group_id)
+
+
+def _invalidate_recipient_counts(group_ids):
+    for pk in group_ids:
+        caching.bump_version(_recipients_version(pk))
+
+
+@receiver(m2m_changed, sender=Group.contacts.through)
+def invalidate_group_recipient_counts(sender, instance, action, reverse,
+                                      pk_set, **kwargs):
+    """ Membership changes invalidate the counts of the groups changed """
+    if reverse and action == 'pre_clear':
+        # instance is a contact, about to leave all its groups
+        instance._recipient_group_ids = list(
+            instance.groups.values_list('pk', flat=True))
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        group_ids = [instance.pk]
+    elif action == 'post_clear':
+        group_ids = getattr(instance, '_recipient_group_ids', [])
+    else:
+        group_ids = pk_set or []
+    _invalidate_recipient_counts(group_ids)
+
+
+@receiver(pre_delete, sender=Contact)
+def remember_contact_groups(sender, instance, **kwargs):
+    """ Memberships are deleted along with the contact, without signals """
+    instance._recipient_group_ids = list(
+        instance.groups.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Contact)
+def invalidate_contact_recipient_counts(sender, instance, **kwargs):
+    _invalidate_recipient_counts(getattr(instance, '_recipient_group_ids',
+                                         []))
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_deleted_group_recipient_counts(sender, instance, **kwargs):
+    _invalidate_recipient_counts([instance.pk])
+
+
+# Number of recent broadcast bodies kept per group
+RECENT_BROADCASTS = 10
+
+
+def _recent_key(group_id=None):
+    return 'broadcast:recent:{0}'.format(group_id or 'all')
+
+
+def _recent_broadcasts(group=None):
+    """
+    Returns (date, body) pairs of the newest active, non-forwarded
+    broadcasts to group, or to any group when group is None. Broadcasts
+    which also go to the confirmations group are only included in the
+    list of that group.
+    """
+    recent = Broadcast.objects.exclude(
+        Q(schedule_frequency__isnull=True) | Q(forward__isnull=False)
+    )
+    confirmation_group = settings.DEFAULT_CONFIRMATIONS_GROUP_NAME
+    if group:
+        recent = recent.filter(groups=group)
+    if not group or group.name != confirmation_group:
+        recent = recent.exclude(groups__name=confirmation_group)
+    recent = recent.order_by('-date').values_list('date', 'body')
+    entries, bodies = [], set()
+    for date, body in recent[:RECENT_BROADCASTS * 5]:
+        if body not in bodies:
+            bodies.add(body)
+            entries.append((date, body))
+        if len(entries) == RECENT_BROADCASTS:
+            break
+    return entries
+
+
+def recent_bodies(groups=None):
+    """
+    Returns the newest distinct broadcast bodies sent to any of the groups,
+    or to all groups except the confirmations group if none are given.
+    The lists of each group are cached until one of its broadcasts changes.
+    """
+    groups = dict([(_recent_key(group.pk), group) for group in groups or []])
+    if not groups:
+        groups = {_recent_key(): None}
+    lists = cache.get_many(groups.keys())
+    for key, group in groups.items():
+        if key not in lists:
+            lists[key] = _recent_broadcasts(group)
+            cache.set(key, lists[key], caching.FOREVER)
+    entries = []
+    for entry_list in lists.values():
+        entries.extend(entry_list)
+    entries.sort(reverse=True)
+    bodies = []
+    for date, body in entries:
+        if body not in bodies:
+            bodies.append(body)
+    return bodies[:RECENT_BROADCASTS]
+
+
+@receiver(post_save, sender=Broadcast)
+@receiver(pre_delete, sender=Broadcast)
+def invalidate_recent_broadcasts(sender, instance, **kwargs):
+    if instance.forward_id:
+        # forwarded broadcasts are never in the recent lists
+        return
+    keys = [_recent_key(pk) for pk in instance.groups.values_list('pk',
+                                                                  flat=True)]
+    _invalidate_recent(keys)
+
+
+@receiver(m2m_changed, sender=Broadcast.groups.through)
+def invalidate_recent_broadcast_groups(sender, instance, action, reverse,
+                                       pk_set, **kwargs):
+    if reverse:
+        # instance is a group, pk_set holds broadcasts
+        keys = [_recent_key(instance.pk)]
+    elif instance.forward_id:
+        return
+    elif action == 'pre_clear':
+        keys = [_recent_key(pk) for pk in
+                instance.groups.values_list('pk', flat=True)]
+    else:
+        keys = [_recent_key(pk) for pk in pk_set or []]
+    _invalidate_recent(keys)
+
+
+def _invalidate_recent(keys):
+    cache.delete_many(keys + [_recent_key()])
+    caching.bump_version('recent')
+    cache.set('broadcast:recent:modified', timezone.now(), caching.FOREVER)
+
+
+def recent_broadcasts_modified():
+    """ When a broadcast shown in the recent bodies last changed, if known """
+    return cache.get('broadcast:recent:modified')
+
+
+def truncated_date(value):
+    """
+    Converts the result of a date_trunc_sql() expression, which is a string
+    on some database backends, to a date.
+    """
+    if isinstance(value, basestring):
+        value = datetime.datetime.strptime(value[:10], '%Y-%m-%d')
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value
+
+
+def date_trunc_select(model, field_name, lookup_type):
+    """
+    Returns SQL for use in extra(select=...) which truncates a date column
+    of model to the given precision ('day', 'month' or 'year').
+    """
+    qn = connection.ops.quote_name
+    column = '{0}.{1}'.format(qn(model._meta.db_table),
+                              qn(model._meta.get_field(field_name).column))
+    return connection.ops.date_trunc_sql(lookup_type, column)
+
+
+class HighWaterMark(models.Model):
+    """ Last row processed by an incremental job """
+
+    name = models.CharField(max_length=64, unique=True)
+    last_id = models.PositiveIntegerField(default=0)
+    date_updated = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'{0} ({1})'.format(self.name, self.last_id)
+
+
+class DailyMessageCountManager(models.Manager):
+
+    def increment(self, count, date, direction, source, backend=None,
+                  rule=None, broadcast=None):
+        """ Add count to the matching row, creating it if necessary """
+        rows = self.filter(date=date, direction=direction, source=source,
+                           backend=backend, rule=rule, broadcast=broadcast)
+        if not rows.update(count=F('count') + count):
+            self.create(date=date, direction=direction, source=source,
+                        backend_id=backend, rule_id=rule,
+                        broadcast_id=broadcast, count=count)
+
+    def totals(self, start_date, end_date):
+        """ Returns (incoming, outgoing) message log totals for the dates """
+        counts = self.filter(
+            source='log', date__range=(start_date, end_date),
+        ).values('direction').annotate(total=Sum('count')).order_by()
+        totals = dict([(row['direction'], row['total']) for row in counts])
+        return totals.get('I', 0), totals.get('O', 0)
+
+    def monthly_totals(self, start_date, end_date):
+        """
+        Returns a dictionary mapping (first day of month, direction) to the
+        message log total for the months between the dates.
+        """
+        month = date_trunc_select(self.model, 'date', 'month')
+        counts = self.filter(
+            source='log', date__range=(start_date, end_date),
+        ).extra(
+            select={'month': month},
+        ).values('month', 'direction').annotate(total=Sum('count')).order_by()
+        return dict([((truncated_date(row['month']), row['direction']),
+                      row['total']) for row in counts])
+
+
+class DailyMessageCount(models.Model):
+    """
+    Number of messages per day, rolled up from the RapidSMS message log and
+    broadcast messages so reports don't need to count individual messages.
+    Broadcast rows break down outgoing traffic by broadcast and forwarding
+    rule; those messages are also part of the message log totals.
+    """
+
+    DIRECTION_CHOICES = (
+        ('I', 'Incoming'),
+        ('O', 'Outgoing'),
+    )
+    SOURCE_CHOICES = (
+        ('log', 'Message log'),
+        ('broadcast', 'Broadcast'),
+    )
+
+    date = models.DateField(db_index=True)
+    direction = models.CharField(max_length=1, choices=DIRECTION_CHOICES)
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES)
+    backend = models.ForeignKey(Backend, null=True, blank=True,
+                                on_delete=models.SET_NULL,
+                                related_name='daily_message_counts')
+    rule = models.ForeignKey(ForwardingRule, null=True, blank=True,
+                             on_delete=models.SET_NULL,
+                             related_name='daily_message_counts')
+    broadcast = models.ForeignKey(Broadcast, null=True, blank=True,
+                                  on_delete=models.SET_NULL,
+                                  related_name='daily_message_counts')
+    count = models.PositiveIntegerField(default=0)
+
+    objects = DailyMessageCountManager()
+
+    class Meta(object):
+        ordering = ('-date',)
+
+    def __unicode__(self):
+        return u'{0} {1} {2}: {3}'.format(self.date, self.source,
+                                          self.get_direction_display(),
+                                          self.count)
+
+
+class UsageReport(models.Model):
+    """
+    Usage report of a past month, built once the month's message counts
+    are final so it can be sent, re-sent and viewed without recomputing it.
+    """
+
+    month = models.DateField(unique=True,
+                             help_text='First day of the reported month')
+    context = models.TextField(help_text='JSON encoded report data')
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    date_created = models.DateTimeField()
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta(object):
+        ordering = ('-month',)
+
+    def __unicode__(self):
+        return self.subject
+
+    def get_context(self):
+        return json.loads(self.context)
+
+    def set_context(self, context):
+        self.context = json.dumps(context)
+
+    def save(self, **kwargs):
+        if not self.pk:
+            self.date_created = timezone.now()
+        return super(UsageReport, self).save(**kwargs)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Per-stage timing of scheduler ticks.
+
+The scheduler records the wall time and number of queries of each stage
+of a tick, per broadcast where a stage works on one. When the tick ends
+the profile is passed to the function named by BROADCAST_PROFILE_HOOK, if
+any, and ticks slower than BROADCAST_SLOW_TICK_SECONDS (60 by default)
+are written to the 'broadcast.slowlog' logger, naming the slowest stage
+and broadcast.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson as json
+from django.utils.importlib import import_module
+
+
+logger = logging.getLogger('broadcast.profiling')
+slow_logger = logging.getLogger('broadcast.slowlog')
+
+
+class TickProfile(object):
+    """ Wall time and queries of the stages of one scheduler tick """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        # (stage, broadcast id) -> [seconds, queries, calls]
+        self.stages = {}
+        self.count_queries = getattr(settings, 'BROADCAST_PROFILE_QUERIES',
+                                     True)
+
+    @contextmanager
+    def stage(self, name, broadcast=None):
+        """
+        Time a stage, for the given broadcast id if any. Stages must not be
+        nested. Queries are counted with Django's debug cursor, and the
+        queries it logs are dropped at the end of the stage unless DEBUG
+        is on, so memory use doesn't grow over a long tick.
+        """
+        old_debug_cursor = connection.use_debug_cursor
+        if self.count_queries:
+            connection.use_debug_cursor = True
+        first_query = len(connection.queries)
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            queries = len(connection.queries) - first_query
+            if self.count_queries:
+                if not old_debug_cursor and not settings.DEBUG:
+                    del connection.queries[first_query:]
+                connection.use_debug_cursor = old_debug_cursor
+            totals = self.stages.setdefault((name, broadcast), [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += queries
+            totals[2] += 1
+
+    def as_dict(self):
+        stages = []
+        for (name, broadcast), (seconds, queries, calls) in \
+          self.stages.items():
+            stages.append({
+                'stage': name,
+                'broadcast': broadcast,
+                'seconds': round(seconds, 6),
+                'queries': queries,
+                'calls': calls,
+            })
+        stages.sort(key=lambda s: s['seconds'], reverse=True)
+        return {
+            'tick': self.name,
+            'seconds': round(self.duration or 0, 6),
+            'queries': sum([s['queries'] for s in stages]),
+            'stages': stages,
+        }
+
+    def finish(self):
+        """ End the tick, pass it to the hook and log it if it was slow """
+        self.duration = time.time() - self.start
+        data = self.as_dict()
+        hook = getattr(settings, 'BROADCAST_PROFILE_HOOK', None)
+        if hook:
+            module, attr = hook.rsplit('.', 1)
+            try:
+                getattr(import_module(module), attr)(data)
+            except Exception, e:
+                logger.exception(e)
+        threshold = getattr(settings, 'BROADCAST_SLOW_TICK_SECONDS', 60)
+        if threshold is not None and self.duration > threshold:
+            slowest = data['stages'] and data['stages'][0] or {}
+            slow_logger.warning(
+                u'Slow {0}: {1:.1f}s, slowest stage {2} of broadcast {3} '
+                u'({4:.1f}s) {5}'.format(
+                    self.name, self.duration, slowest.get('stage'),
+                    slowest.get('broadcast'), slowest.get('seconds', 0),
+                    json.dumps(data)),
+                extra={'profile': data})
+        return data
+
+
+@contextmanager
+def profiled(name, profile=None):
+    """
+    Yields profile, or a new TickProfile which is finished when the block
+    ends, so functions can be profiled on their own or as part of a tick.
+    """
+    if profile is not None:
+        yield profile
+        return
+    profile = TickProfile(name)
+    try:
+        yield profile
+    finally:
+        profile.finish()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Delivery receipts (DLRs) of sent broadcast messages.
+
+A receipt names a message by its external id, the id of the outgoing
+message returned by the router when it was sent, which backends pass on to
+their provider. Receipts are applied a chunk at a time, with one UPDATE
+per chunk, delivery status and table, so large batches don't update rows
+one by one. Messages archived before their receipt arrived are updated in
+the archive table.
+"""
+import itertools
+
+from django.db import transaction
+from django.utils import simplejson as json
+from django.utils import timezone
+
+from broadcast import metrics
+from broadcast.models import ArchivedBroadcastMessage, BroadcastMessage
+
+
+# receipt status, as reported by common providers -> message status
+STATUSES = {
+    'delivered': 'delivered',
+    'delivrd': 'delivered',
+    'success': 'delivered',
+    'undelivered': 'undelivered',
+    'undeliv': 'undelivered',
+    'failed': 'undelivered',
+    'rejected': 'undelivered',
+    'rejectd': 'undelivered',
+    'expired': 'undelivered',
+}
+
+# message statuses a receipt may change, so a late failure doesn't undo a
+# delivery
+FROM_STATUSES = {
+    'delivered': ('sent', 'undelivered'),
+    'undelivered': ('sent',),
+}
+
+
+def parse_lines(lines):
+    """
+    Yields (external id, status) pairs of receipts given as JSON objects
+    with 'id' and 'status' keys, one per line. Raises ValueError if a line
+    isn't such an object.
+    """
+    for line in lines:
+        if line.strip():
+            yield _pair(json.loads(line))
+
+
+def parse_body(body):
+    """ Receipts of a request body, a JSON list or JSON lines """
+    if body.lstrip().startswith('['):
+        return [_pair(item) for item in json.loads(body)]
+    return parse_lines(body.splitlines())
+
+
+def _pair(item):
+    if not isinstance(item, dict):
+        raise ValueError(u'Receipts must be objects: {0!r}'.format(item))
+    return item.get('id'), item.get('status')
+
+
+def apply_receipts(receipts, chunk_size=500):
+    """
+    Update the status of the messages named by an iterable of
+    (external id, status) receipts. Returns the number of messages marked
+    delivered and undelivered, and of receipts which were ignored because
+    their status is unknown or they matched no sent message.
+    """
+    counts = {'delivered': 0, 'undelivered': 0, 'ignored': 0}
+    receipts = iter(receipts)
+    while True:
+        chunk = list(itertools.islice(receipts, chunk_size))
+        if not chunk:
+            break
+        by_status = {}
+        for external_id, status in chunk:
+            status = STATUSES.get(unicode(status or u'').lower())
+            if not external_id or not status:
+                counts['ignored'] += 1
+                continue
+            by_status.setdefault(status, set()).add(unicode(external_id))
+        now = timezone.now()
+        with transaction.commit_on_success():
+            # failures first, so a delivery in the same chunk wins
+            for status in ('undelivered', 'delivered'):
+                ids = by_status.get(status)
+                if not ids:
+                    continue
+                updated = 0
+                for model in (BroadcastMessage, ArchivedBroadcastMessage):
+                    updated += model.objects.filter(
+                        external_id__in=ids,
+                        status__in=FROM_STATUSES[status],
+                    ).update(status=status, date_delivered=now)
+                counts[status] += updated
+                counts['ignored'] += len(ids) - updated
+    for status in ('delivered', 'undelivered'):
+        if counts[status]:
+            metrics.incr(status, counts[status])
+    return counts
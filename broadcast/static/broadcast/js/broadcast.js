@@ -6,6 +6,51 @@ $(document).ready(function() {
     $('.datetimepicker').datetimepicker();
     $('.multiselect').multiselect({header: false, selectedList: 3});
 
+    /* Selects with a data-url only render their selected options; others
+     * are searched for and added on demand. */
+    $('select.multiselect[data-url]').each(function() {
+        var select = $(this);
+        var url = select.data('url');
+        var search = $('<input>').attr({type: 'text', placeholder: 'Search'}).addClass('option-search');
+        var more = $('<a>').attr('href', '#').addClass('option-more hide').text('More');
+        var timer = null;
+        var last = null;
+
+        function addOptions(data) {
+            $.each(data.results, function(i, r) {
+                if (!select.find('option[value=' + r.id + ']').length) {
+                    select.append($('<option>').val(r.id).text(r.name));
+                }
+                last = r.name;
+            });
+            more.toggleClass('hide', !data.more);
+            select.multiselect('refresh');
+            select.multiselect('open');
+        }
+
+        function load(after) {
+            var params = {q: search.val()};
+            if (after) {
+                params.after = after;
+            }
+            $.getJSON(url, params, addOptions);
+        }
+
+        search.keyup(function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                // drop unselected options of the previous search
+                select.find('option:not(:selected)').remove();
+                load();
+            }, 250);
+        });
+        more.click(function(e) {
+            e.preventDefault();
+            load(last);
+        });
+        select.before(search).parent().append(more);
+    });
+
     var span1 = $('<span>').attr('id', 'count').text(0);
     var span2 = $('<span>').text(' characters remaining');
     var counter = $('<div>').addClass('counter').append(span1).append(span2);
@@ -68,9 +113,8 @@ $(document).ready(function() {
 
     var messageUrl = $('#message-data').attr('href');
     function queryMessages() {
-        var now = new Date().getTime();
         var groups = getSelected();
-        $.getJSON(messageUrl, {groups: groups, timestamp: now}, showMessages);
+        $.getJSON(messageUrl, {groups: groups}, showMessages);
     }
 
     function getSelected() {
@@ -83,6 +127,27 @@ $(document).ready(function() {
 
     $('#id_groups').bind("multiselectclick", queryMessages);
 
+    var recipientUrl = $('#recipient-count').attr('href');
+    function queryRecipients() {
+        if (!recipientUrl) {
+            return;
+        }
+        $.getJSON(recipientUrl, {groups: getSelected()}, showRecipients);
+    }
+
+    function showRecipients(data) {
+        $('.recipient-count').remove();
+        var text = 'This will reach ' + data.count + ' contact';
+        if (data.count != 1) {
+            text += 's';
+        }
+        $('#id_groups').parent().append($('<p>').addClass('recipient-count').text(text));
+    }
+
+    queryRecipients();
+
+    $('#id_groups').bind("multiselectclick", queryRecipients);
+
     function showMessages(data) {
         $('#message-data').remove();
         $('.message-list ul.message-data').remove();
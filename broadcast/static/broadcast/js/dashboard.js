@@ -15,8 +15,7 @@ function drawChart(response) {
 }
 function getChartData() {
     var url = $('#usage-chart').data('url');
-    var now = new Date().getTime();
-    $.getJSON(url, {timestamp: now}, drawChart);
+    $.getJSON(url, drawChart);
 }
 $(document).ready(function() {
     $('.form-action input[type=submit]').button();
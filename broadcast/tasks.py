@@ -3,7 +3,8 @@
 from celery.registry import tasks
 from celery.task import Task
 
-from broadcast.app import scheduler_callback
+from broadcast.app import (scheduler_callback, send_queued_messages,
+    update_message_counts, build_usage_reports, archive_broadcast_messages)
 
 
 class BroadcastCronTask(Task):
@@ -12,3 +13,28 @@ class BroadcastCronTask(Task):
 
 
 tasks.register(BroadcastCronTask)
+
+
+class SendQueuedMessagesTask(Task):
+    def run(self):
+        send_queued_messages()
+
+
+tasks.register(SendQueuedMessagesTask)
+
+
+class MessageCountTask(Task):
+    def run(self):
+        update_message_counts()
+        build_usage_reports()
+
+
+tasks.register(MessageCountTask)
+
+
+class ArchiveTask(Task):
+    def run(self):
+        archive_broadcast_messages()
+
+
+tasks.register(ArchiveTask)
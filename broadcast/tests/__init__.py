@@ -1,3 +1,4 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 from .test_broadcast import *
+from .test_query_budgets import *
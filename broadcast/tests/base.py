@@ -6,8 +6,9 @@ import logging
 import random
 import string
 
+from django.core.cache import cache
 from django.core.management import call_command
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.test import TestCase
 
 from rapidsms.models import Connection, Contact, Backend
@@ -25,6 +26,11 @@ UNICODE_CHARS = [unichr(x) for x in xrange(1, 0xD7FF)]
 class CreateDataTest(TestCase):
     """ Base test case that provides helper functions to create data """
 
+    def _pre_setup(self):
+        super(CreateDataTest, self)._pre_setup()
+        # cached reports and counts must not leak between tests
+        cache.clear()
+
     def random_string(self, length=255, extra_chars=''):
         chars = string.letters + extra_chars
         return ''.join([random.choice(chars) for i in range(length)])
@@ -71,6 +77,55 @@ class CreateDataTest(TestCase):
         return Group.objects.create(**defaults)
 
 
+class QueryBudgetMixin(object):
+    """
+    Assertions on the number of queries a code path makes, so N+1 query
+    patterns are caught by the tests rather than in production.
+    """
+
+    def count_queries(self, func, *args, **kwargs):
+        """ Number of queries func makes on the default database """
+        conn = connections[DEFAULT_DB_ALIAS]
+        old_debug_cursor = conn.use_debug_cursor
+        conn.use_debug_cursor = True
+        start = len(conn.queries)
+        try:
+            func(*args, **kwargs)
+            return len(conn.queries) - start
+        finally:
+            conn.use_debug_cursor = old_debug_cursor
+
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        """ Fails if func makes more than budget queries """
+        count = self.count_queries(func, *args, **kwargs)
+        self.assertTrue(count <= budget, '{0} made {1} queries, budget is '
+                        '{2}'.format(getattr(func, '__name__', func), count,
+                                     budget))
+        return count
+
+    def assertQueryScaling(self, budget, grow, func, sizes=(2, 10),
+                           per_row=0, warm_up=True):
+        """
+        Calls grow(size) for each size, to add rows, and then counts the
+        queries of func, after a first call to warm up caches unless
+        warm_up is False. Fails if a count exceeds budget plus per_row
+        queries per row, or, when per_row is 0, if the count changes with
+        the number of rows.
+        """
+        counts = []
+        for size in sizes:
+            grow(size)
+            if warm_up:
+                func()
+            counts.append(self.assertQueryBudget(budget + per_row * size,
+                                                 func))
+        if not per_row:
+            self.assertEqual(len(set(counts)), 1, 'Queries grew with the '
+                             'number of rows: {0} for {1} rows'.format(
+                                 counts, list(sizes)))
+        return counts
+
+
 class BroadcastCreateDataTest(CreateDataTest):
     """ Base test case that provides helper functions for Broadcast data """
 
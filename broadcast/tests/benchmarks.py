@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+"""
+Performance benchmarks for the broadcast app.
+
+These are not part of the regular test suite. Run them with::
+
+    python benchmark.py
+
+Each benchmark appends one JSON line per run to the results file so that
+numbers can be compared between releases.
+"""
+import datetime
+import math
+import os
+import random
+import string
+from timeit import default_timer
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.utils import simplejson as json
+from django.utils import timezone
+
+from rapidsms.contrib.messagelog.models import Message
+from rapidsms.messages.incoming import IncomingMessage
+from rapidsms.models import Backend, Connection, Contact
+from rapidsms.router import get_router
+from rapidsms.tests.harness import MockBackend, MockRouter
+
+from groups.models import Group
+
+import broadcast
+from broadcast.app import (BroadcastApp, queue_outgoing_messages,
+    send_queued_messages, update_message_counts)
+from broadcast.models import Broadcast, BroadcastMessage
+from broadcast.tests.base import BroadcastCreateDataTest
+from broadcast.views import usage_report_context
+
+
+# Benchmark parameters; benchmark.py overrides these from the command line.
+OPTIONS = {
+    'rules': 20,
+    'groups': 10,
+    'contacts': 200,
+    'messages': 500,
+    'seed': 0,
+    'bulk_contacts': 100000,
+    'bulk_groups': 100,
+    'bulk_broadcasts': 1000,
+    'bulk_log_messages': 100000,
+    'ready_broadcasts': 5,
+    'send_batches': 20,
+    'repeat': 10,
+    'output': 'benchmark_results.jsonl',
+}
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers """
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class BenchmarkMixin(object):
+    """ Helpers to time callables and store the results of a benchmark """
+
+    def start_query_log(self):
+        self._old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        del connection.queries[:]
+
+    def stop_query_log(self):
+        connection.use_debug_cursor = self._old_debug_cursor
+        del connection.queries[:]
+
+    def measure(self, func, *args, **kwargs):
+        """
+        Call func and return a tuple of (result, elapsed seconds, number of
+        queries). The query log must have been started first.
+        """
+        del connection.queries[:]
+        start = default_timer()
+        result = func(*args, **kwargs)
+        elapsed = default_timer() - start
+        return result, elapsed, len(connection.queries)
+
+    def summarize(self, latencies, queries):
+        """ Calculate throughput, latency and query statistics """
+        total = sum(latencies)
+        count = len(latencies)
+        return {
+            'count': count,
+            'seconds': total,
+            'per_second': total and count / total or None,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries_per_call': float(sum(queries)) / count,
+        }
+
+    def previous_result(self, name, params):
+        """ Most recent stored result of the same benchmark and parameters """
+        previous = None
+        path = OPTIONS['output']
+        if not path or not os.path.exists(path):
+            return None
+        for line in open(path):
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get('name') == name and result.get('params') == params:
+                previous = result
+        return previous
+
+    def record(self, name, params, metrics):
+        """ Print a benchmark result and append it to the results file """
+        previous = self.previous_result(name, params)
+        result = {
+            'name': name,
+            'version': broadcast.__version__,
+            'date': datetime.datetime.now().isoformat(),
+            'params': params,
+            'metrics': metrics,
+        }
+        lines = [u'{0} ({1})'.format(name, u', '.join(
+            [u'{0}={1}'.format(k, v) for k, v in sorted(params.items())]))]
+        for key, value in sorted(metrics.items()):
+            line = u'    {0}: {1}'.format(key, value)
+            before = previous and previous['metrics'].get(key)
+            if before and value is not None:
+                change = (value - before) * 100.0 / before
+                line += u' ({0:+.1f}% vs {1})'.format(change,
+                                                      previous['version'])
+            lines.append(line)
+        print(u'\n'.join(lines))
+        if OPTIONS['output']:
+            output = open(OPTIONS['output'], 'a')
+            try:
+                output.write(json.dumps(result) + '\n')
+            finally:
+                output.close()
+        return result
+
+
+class ForwardingBenchmark(BenchmarkMixin, BroadcastCreateDataTest):
+    """ Inbound message throughput of BroadcastApp.handle """
+
+    def setUp(self):
+        self.random = random.Random(OPTIONS['seed'])
+        self.backend = self.create_backend(name='mockbackend')
+        groups = [self.create_group() for i in range(OPTIONS['groups'])]
+        self.connections = []
+        for i in range(OPTIONS['contacts']):
+            contact = self.create_contact()
+            contact.groups.add(groups[i % len(groups)])
+            conn = self.create_connection(contact=contact,
+                                          backend=self.backend)
+            self.connections.append(conn)
+        self.keywords = []
+        for i in range(OPTIONS['rules']):
+            rule = self.create_forwarding_rule(
+                source=self.random.choice(groups),
+                dest=self.random.choice(groups),
+            )
+            self.keywords.append(rule.keyword)
+        self.app = BroadcastApp(router=MockRouter())
+
+    def test_handle(self):
+        """ Push a stream of keyword messages through handle() """
+        latencies, queries = [], []
+        self.start_query_log()
+        try:
+            for i in range(OPTIONS['messages']):
+                conn = self.random.choice(self.connections)
+                text = u'{0} {1}'.format(self.random.choice(self.keywords),
+                                         self.random_string(40))
+                msg = IncomingMessage(conn, text)
+                _, elapsed, count = self.measure(self.app.handle, msg)
+                latencies.append(elapsed)
+                queries.append(count)
+        finally:
+            self.stop_query_log()
+        params = dict([(k, OPTIONS[k]) for k in
+                       ('rules', 'groups', 'contacts', 'messages')])
+        self.record('forwarding.handle', params,
+                    self.summarize(latencies, queries))
+
+
+class SyntheticData(object):
+    """
+    Bulk creates large synthetic data sets. Rows are inserted with
+    bulk_create, so creating 100k contacts takes seconds rather than the
+    minutes CreateDataTest would need.
+    """
+
+    batch_size = 500
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.now = timezone.now()
+
+    def bulk_create(self, model, objects):
+        """ bulk_create in batches, which Django 1.4 can't do by itself """
+        for start in range(0, len(objects), self.batch_size):
+            model.objects.bulk_create(objects[start:start + self.batch_size])
+
+    def text(self, length):
+        return u''.join([self.random.choice(string.letters)
+                         for i in range(length)])
+
+    def create_contacts(self, count, groups, backend_name='mockbackend'):
+        """
+        Creates count contacts with one connection each. Every contact is
+        in one of the given number of groups, and every tenth contact in a
+        second one. Returns the groups.
+        """
+        backend, _ = Backend.objects.get_or_create(name=backend_name)
+        first = Contact.objects.count()
+        self.bulk_create(Contact, [
+            Contact(name=u'Contact {0}'.format(first + i))
+            for i in range(count)])
+        contact_ids = list(Contact.objects.order_by('pk').values_list(
+            'pk', flat=True)[first:])
+        self.bulk_create(Connection, [
+            Connection(contact_id=pk, backend=backend,
+                       identity=u'+1{0:010d}'.format(pk))
+            for pk in contact_ids])
+        names = [u'Group {0} {1}'.format(first, i) for i in range(groups)]
+        Group.objects.bulk_create([Group(name=name) for name in names])
+        groups = list(Group.objects.filter(name__in=names).order_by('pk'))
+        Membership = Group.contacts.through
+        members = []
+        for i, pk in enumerate(contact_ids):
+            members.append(Membership(group_id=groups[i % len(groups)].pk,
+                                      contact_id=pk))
+            if i % 10 == 0:
+                other = groups[(i * 7 + 1) % len(groups)]
+                if other != groups[i % len(groups)]:
+                    members.append(Membership(group_id=other.pk,
+                                              contact_id=pk))
+        self.bulk_create(Membership, members)
+        return groups
+
+    def create_broadcasts(self, count, groups, ready=False, days=365):
+        """
+        Creates count broadcasts to one random group each, with random
+        frequencies and dates within days of now. Ready broadcasts are
+        dated in the past, others in the future.
+        """
+        frequencies = [c[0] for c in Broadcast.REPEAT_CHOICES if c[0]]
+        body = self.text(140)
+        broadcasts = []
+        for i in range(count):
+            offset = datetime.timedelta(seconds=self.random.randint(
+                60, days * 24 * 60 * 60))
+            broadcasts.append(Broadcast(
+                date_created=self.now,
+                date=ready and self.now - offset or self.now + offset,
+                schedule_frequency=self.random.choice(frequencies),
+                body=body,
+            ))
+        first = Broadcast.objects.count()
+        self.bulk_create(Broadcast, broadcasts)
+        broadcast_ids = list(Broadcast.objects.order_by('pk').values_list(
+            'pk', flat=True)[first:])
+        Recipients = Broadcast.groups.through
+        self.bulk_create(Recipients, [
+            Recipients(broadcast_id=pk, group_id=self.random.choice(groups).pk)
+            for pk in broadcast_ids])
+        return broadcast_ids
+
+    def create_queued_messages(self, broadcast_id, contacts):
+        """ Queues a message of the broadcast to up to contacts contacts """
+        contact_ids = Contact.objects.order_by('pk').values_list(
+            'pk', flat=True)[:contacts]
+        self.bulk_create(BroadcastMessage, [
+            BroadcastMessage(broadcast_id=broadcast_id, recipient_id=pk,
+                             date_created=self.now, status='queued')
+            for pk in contact_ids])
+
+    def create_message_log(self, count, days=365):
+        """ Logs count messages of random connections over the last days """
+        connections = list(Connection.objects.values_list('pk', 'contact'))
+        messages = []
+        for i in range(count):
+            connection_id, contact_id = self.random.choice(connections)
+            offset = datetime.timedelta(seconds=self.random.randint(
+                0, days * 24 * 60 * 60))
+            messages.append(Message(
+                connection_id=connection_id, contact_id=contact_id,
+                direction=self.random.choice('IO'), date=self.now - offset,
+                text=self.text(20)))
+        self.bulk_create(Message, messages)
+
+
+class PipelineBenchmark(BenchmarkMixin, BroadcastCreateDataTest):
+    """
+    Queueing, sending and reporting with a large synthetic data set, sized
+    by the bulk_* options.
+    """
+
+    def setUp(self):
+        self.data = SyntheticData(OPTIONS['seed'])
+        self.groups = self.data.create_contacts(OPTIONS['bulk_contacts'],
+                                                OPTIONS['bulk_groups'])
+        self.params = dict([(k, OPTIONS[k]) for k in
+                            ('bulk_contacts', 'bulk_groups')])
+
+    def run_timed(self, name, func, times, params, extra=None):
+        """
+        Call func the given number of times and record the result, with the
+        metrics returned by extra(metrics) once the calls are done, if given
+        """
+        latencies, queries = [], []
+        self.start_query_log()
+        try:
+            for i in range(times):
+                cache.clear()
+                _, elapsed, count = self.measure(func)
+                latencies.append(elapsed)
+                queries.append(count)
+        finally:
+            self.stop_query_log()
+        metrics = self.summarize(latencies, queries)
+        if extra:
+            metrics.update(extra(metrics))
+        return self.record(name, params, metrics)
+
+    def test_queue_outgoing_messages(self):
+        """ Fan out the ready broadcasts to their groups' contacts """
+        self.data.create_broadcasts(OPTIONS['bulk_broadcasts'], self.groups)
+        self.data.create_broadcasts(OPTIONS['ready_broadcasts'], self.groups,
+                                    ready=True)
+        params = dict(self.params, bulk_broadcasts=OPTIONS['bulk_broadcasts'],
+                      ready_broadcasts=OPTIONS['ready_broadcasts'])
+
+        def queued(metrics):
+            count = BroadcastMessage.objects.count()
+            seconds = metrics['seconds']
+            return {'queued': count,
+                    'queued_per_second': seconds and count / seconds or None}
+
+        self.run_timed('pipeline.queue_outgoing_messages',
+                       queue_outgoing_messages, 1, params, extra=queued)
+
+    def test_send_queued_messages(self):
+        """ Send batches of queued messages through the mock backend """
+        get_router()(backends={'mockbackend': {'ENGINE': MockBackend}})
+        broadcast_id = self.data.create_broadcasts(1, self.groups)[0]
+        self.data.create_queued_messages(broadcast_id,
+                                         OPTIONS['send_batches'] * 50)
+        params = dict(self.params, send_batches=OPTIONS['send_batches'])
+        self.run_timed('pipeline.send_queued_messages', send_queued_messages,
+                       OPTIONS['send_batches'], params)
+
+    def test_get_next_date(self):
+        """ Next dates of recurring broadcasts started up to a year ago """
+        self.data.create_broadcasts(OPTIONS['bulk_broadcasts'], self.groups,
+                                    ready=True)
+        broadcasts = iter(list(Broadcast.objects.all()))
+        params = {'bulk_broadcasts': OPTIONS['bulk_broadcasts']}
+        self.run_timed('pipeline.get_next_date',
+                       lambda: broadcasts.next().get_next_date(),
+                       OPTIONS['bulk_broadcasts'], params)
+
+    def test_reports(self):
+        """ Count the message log, then build the usage reports from it """
+        self.data.create_message_log(OPTIONS['bulk_log_messages'])
+        params = dict(self.params,
+                      bulk_log_messages=OPTIONS['bulk_log_messages'])
+        self.run_timed('pipeline.update_message_counts',
+                       update_message_counts, 1, params)
+        today = datetime.date.today()
+        start_date = today.replace(day=1)
+        self.run_timed('pipeline.usage_report_context',
+                       lambda: usage_report_context(start_date, today),
+                       OPTIONS['repeat'], params)
+        self.login()
+        url = reverse('broadcast-usage-graph-data')
+        self.run_timed('pipeline.report_graph_data',
+                       lambda: self.client.get(url), OPTIONS['repeat'],
+                       params)
+
+    def test_schedule(self):
+        """ Render the first page of the broadcast schedule """
+        self.data.create_broadcasts(OPTIONS['bulk_broadcasts'], self.groups)
+        params = dict(self.params, bulk_broadcasts=OPTIONS['bulk_broadcasts'])
+        self.login()
+        url = reverse('broadcast-schedule')
+        self.run_timed('pipeline.schedule', lambda: self.client.get(url),
+                       OPTIONS['repeat'], params)
+
+    def login(self):
+        User.objects.create_user('benchmark', 'a@b.com', 'benchmark')
+        self.client.login(username='benchmark', password='benchmark')
@@ -1,20 +1,38 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 import datetime
+import logging
+import time
 from dateutil import rrule
 from dateutil.relativedelta import relativedelta
 
 from django.contrib.auth.models import User
+from django.core import mail
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from django.utils import simplejson as json
+from django.utils import timezone
 
+from rapidsms.contrib.messagelog.models import Message
 from rapidsms.messages.incoming import IncomingMessage
 from rapidsms.router import get_router
 from rapidsms.tests.harness import MockRouter, MockBackend
 
-from broadcast.app import BroadcastApp, scheduler_callback
+from groups.models import Group
+
+from broadcast import metrics
+from broadcast.app import (BroadcastApp, archive_broadcast_messages,
+    build_usage_report, last_month, scheduler_callback, update_message_counts,
+    update_queue_metrics, usage_email_callback)
+from broadcast.export import export_rows
 from broadcast.forms import BroadcastForm
-from broadcast.models import Broadcast, ForwardingRule
+from broadcast.models import (ArchivedBroadcastMessage, Broadcast,
+    BroadcastMessage, BroadcastStats, DailyMessageCount, ForwardingRule,
+    HighWaterMark, RecipientClaim, RecipientSnapshot, UsageReport,
+    recent_bodies)
 from broadcast.tests.base import BroadcastCreateDataTest
+from broadcast.views import (approximate_count, cached_usage_report_context,
+    is_closed_period, monthly_message_counts, usage_report_context)
 
 
 class DateAttributeTest(BroadcastCreateDataTest):
@@ -125,6 +143,79 @@ class BroadcastAppTest(BroadcastCreateDataTest):
         self.assertTrue(c1.pk in contacts)
         self.assertFalse(c2.pk in contacts)
 
+    def test_bound_connections(self):
+        """ Messages are bound to connections, or flagged, when queued """
+        group = self.create_group()
+        contact = self.create_contact()
+        first = self.create_connection(contact=contact)
+        self.create_connection(contact=contact)
+        unreachable = self.create_contact()
+        contact.groups.add(group)
+        unreachable.groups.add(group)
+        broadcast = self.create_broadcast(groups=[group])
+        # a backlog from an earlier run isn't reduced by unreachable ones
+        BroadcastStats.objects.add_queued(broadcast.pk, 5)
+        self.assertEqual(broadcast.queue_outgoing_messages(), 1)
+        message = broadcast.messages.get(recipient=contact)
+        self.assertEqual((message.connection, message.status),
+                         (first, 'queued'))
+        message = broadcast.messages.get(recipient=unreachable)
+        self.assertEqual((message.connection, message.status),
+                         (None, 'unreachable'))
+        stats = BroadcastStats.objects.get(broadcast=broadcast)
+        self.assertEqual((stats.queued, stats.errors), (6, 1))
+
+    def test_suppression_window(self):
+        """ Recent duplicates are skipped and counted per broadcast """
+        group = self.create_group()
+        for i in range(2):
+            contact = self.create_contact()
+            self.create_connection(contact=contact)
+            contact.groups.add(group)
+        newcomer = self.create_contact()
+        self.create_connection(contact=newcomer)
+        other = self.create_group()
+        newcomer.groups.add(other)
+        first = self.create_broadcast(body=u'hello', groups=[group])
+        first.queue_outgoing_messages()
+        second = self.create_broadcast(body=u'hello', groups=[group, other])
+        with self.settings(BROADCAST_SUPPRESSION_SECONDS=300):
+            self.assertEqual(second.queue_outgoing_messages(), 1)
+        self.assertEqual(list(second.messages.values_list('recipient',
+                                                          flat=True)),
+                         [newcomer.pk])
+        stats = BroadcastStats.objects.get(broadcast=second)
+        self.assertEqual((stats.queued, stats.suppressed), (1, 2))
+        # different bodies and disabled windows aren't suppressed
+        third = self.create_broadcast(body=u'bye', groups=[group])
+        with self.settings(BROADCAST_SUPPRESSION_SECONDS=300):
+            self.assertEqual(third.queue_outgoing_messages(), 2)
+        self.assertEqual(second.queue_outgoing_messages(), 3)
+
+    def test_recipient_count(self):
+        """ Recipient counts are cached until group membership changes """
+        c1 = self.create_contact()
+        c2 = self.create_contact()
+        g1 = self.create_group()
+        g2 = self.create_group()
+        c1.groups.add(g1, g2)
+        broadcast = self.create_broadcast(groups=[g1, g2])
+        self.assertEqual(broadcast.recipient_count(), 1)
+        with self.assertNumQueries(1):
+            # only the broadcast's groups are loaded
+            self.assertEqual(broadcast.recipient_count(), 1)
+        other = self.create_broadcast(groups=[g1])
+        self.assertEqual(other.recipient_count(), 1)
+        c2.groups.add(g2)
+        self.assertEqual(broadcast.recipient_count(), 2)
+        with self.assertNumQueries(1):
+            # g1's count is still cached
+            self.assertEqual(other.recipient_count(), 1)
+        c2.delete()
+        self.assertEqual(broadcast.recipient_count(), 1)
+        c1.groups.clear()
+        self.assertEqual(other.recipient_count(), 0)
+
     def test_ready_manager(self):
         """ test Broadcast.ready manager returns broadcasts ready to go out """
         b1 = self.create_broadcast(when='ready')
@@ -133,6 +224,142 @@ class BroadcastAppTest(BroadcastCreateDataTest):
         self.assertTrue(b1.pk in ready)
         self.assertFalse(b2.pk in ready)
 
+    def test_backlog(self):
+        """ Queued messages are counted by broadcast and age """
+        b1 = self.create_broadcast()
+        b2 = self.create_broadcast()
+        contact = self.create_contact()
+        for i in range(3):
+            b1.messages.create(recipient=contact)
+        old = b2.messages.create(recipient=contact)
+        BroadcastMessage.objects.filter(pk=old.pk).update(
+            date_created=datetime.datetime.now() - relativedelta(hours=2))
+        b2.messages.create(recipient=contact, status='sent')
+        backlog = BroadcastMessage.objects.backlog()
+        self.assertEqual(backlog['total'], 4)
+        rows = dict([(row['broadcast_id'], row['counts'])
+                     for row in backlog['broadcasts']])
+        self.assertEqual(rows, {b1.pk: [3, 0, 0, 0, 0],
+                                b2.pk: [0, 0, 1, 0, 0]})
+        self.assertEqual(backlog['backends'], [('none', 4)])
+
+    def test_requeue_and_cancel(self):
+        """ Requeueing and cancelling keep the delivery stats in step """
+        broadcast = self.create_broadcast()
+        contact = self.create_contact()
+        for status in ('queued', 'error', 'error'):
+            broadcast.messages.create(recipient=contact, status=status)
+        BroadcastStats.objects.create(broadcast=broadcast, queued=1, errors=2)
+        messages = BroadcastMessage.objects.filter(broadcast=broadcast)
+        self.assertEqual(BroadcastMessage.objects.requeue(messages), 2)
+        stats = BroadcastStats.objects.get(broadcast=broadcast)
+        self.assertEqual((stats.queued, stats.errors), (3, 0))
+        self.assertEqual(BroadcastMessage.objects.cancel(messages), 3)
+        self.assertEqual(messages.filter(status='cancelled').count(), 3)
+        stats = BroadcastStats.objects.get(broadcast=broadcast)
+        self.assertEqual(stats.queued, 0)
+
+    def test_claim(self):
+        """ Senders lease distinct messages and reclaim expired leases """
+        broadcast = self.create_broadcast()
+        contact = self.create_contact()
+        for i in range(3):
+            broadcast.messages.create(recipient=contact)
+        manager = BroadcastMessage.objects
+        first = manager.claim(2, 'a')
+        self.assertEqual([m.worker for m in first], ['a', 'a'])
+        self.assertEqual(set([m.status for m in first]), set(['sending']))
+        second = manager.claim(2, 'b')
+        self.assertEqual(len(second), 1)
+        self.assertFalse(second[0].pk in [m.pk for m in first])
+        self.assertEqual(manager.claim(2, 'c'), [])
+        manager.filter(worker='a').update(
+            lease_expires=datetime.datetime.now() - relativedelta(minutes=1))
+        reclaimed = manager.claim(5, 'c')
+        self.assertEqual(sorted([m.pk for m in reclaimed]),
+                         sorted([m.pk for m in first]))
+
+    def test_claim_recipients(self):
+        """ Senders lease distinct snapshot recipients until they are sent """
+        broadcast = self.create_broadcast()
+        ids = [self.create_contact().pk for i in range(5)]
+        snapshot = RecipientSnapshot(broadcast=broadcast)
+        snapshot.set_recipients(ids)
+        snapshot.save()
+        manager = RecipientSnapshot.objects
+        first = manager.claim(3, 'a')
+        self.assertEqual([list(c.get_recipients()) for c in first], [ids[:3]])
+        second = manager.claim(3, 'b')
+        self.assertEqual([list(c.get_recipients()) for c in second],
+                         [ids[3:]])
+        self.assertEqual(manager.claim(3, 'c'), [])
+        RecipientClaim.objects.filter(worker='a').update(
+            lease_expires=datetime.datetime.now() - relativedelta(minutes=1))
+        reclaimed = manager.claim(3, 'c')
+        self.assertEqual([(c.worker, list(c.get_recipients()))
+                          for c in reclaimed], [('c', ids[:3])])
+        self.assertEqual(manager.claim(3, 'a'), [])
+
+    def test_retry_backoff(self):
+        """ Failed messages are retried with backoff after fresh ones """
+        broadcast = self.create_broadcast()
+        contact = self.create_contact()
+        message = broadcast.messages.create(recipient=contact)
+        now = datetime.datetime.now()
+        with self.settings(BROADCAST_RETRY_SECONDS=60,
+                           BROADCAST_MAX_ATTEMPTS=3):
+            self.assertTrue(message.failed(now))
+            message.save()
+            self.assertEqual(message.status, 'queued')
+            self.assertEqual(message.next_attempt,
+                             now + relativedelta(seconds=60))
+            self.assertTrue(message.failed(now))
+            message.save()
+            self.assertEqual(message.next_attempt,
+                             now + relativedelta(seconds=120))
+            self.assertFalse(message.failed(now))
+            message.save()
+            self.assertEqual((message.status, message.attempts), ('error', 3))
+        # failed() only changes the instance, callers save it
+        permanent = broadcast.messages.create(recipient=contact)
+        self.assertFalse(permanent.failed(now, transient=False))
+        permanent.save()
+        self.assertEqual(BroadcastMessage.objects.get(pk=permanent.pk).status,
+                         'error')
+        retry = broadcast.messages.create(
+            recipient=contact, attempts=1, next_attempt=now - relativedelta(
+                minutes=1))
+        later = broadcast.messages.create(
+            recipient=contact, attempts=1, next_attempt=now + relativedelta(
+                minutes=5))
+        fresh = broadcast.messages.create(recipient=contact)
+        manager = BroadcastMessage.objects
+        self.assertEqual(manager.claim(1, 'a'), [fresh])
+        self.assertEqual(manager.claim(5, 'a'), [retry])
+        self.assertEqual(manager.claim(5, 'a'), [])
+
+    def test_delivery_stats(self):
+        """ Queued and sent messages are counted per broadcast """
+        group = self.create_group()
+        for i in range(3):
+            contact = self.create_contact()
+            self.create_connection(contact=contact)
+            contact.groups.add(group)
+        broadcast = self.create_broadcast(groups=[group])
+        broadcast.queue_outgoing_messages()
+        stats = BroadcastStats.objects.get(broadcast=broadcast)
+        self.assertEqual((stats.queued, stats.sent, stats.errors), (3, 0, 0))
+        start = datetime.datetime.now()
+        sent = [(start, start + datetime.timedelta(seconds=3)),
+                (start, start + datetime.timedelta(minutes=10))]
+        BroadcastStats.objects.add_results(broadcast.pk, sent, 1)
+        stats = BroadcastStats.objects.get(broadcast=broadcast)
+        self.assertEqual((stats.queued, stats.sent, stats.errors), (0, 2, 1))
+        self.assertEqual(stats.date_first_sent, sent[0][1])
+        self.assertEqual(stats.date_last_sent, sent[1][1])
+        self.assertEqual(stats.latency_percentile(50), 5)
+        self.assertEqual(stats.latency_percentile(99), 600)
+
 
 class BroadcastFormTest(BroadcastCreateDataTest):
     def setUp(self):
@@ -203,6 +430,14 @@ class BroadcastFormTest(BroadcastCreateDataTest):
         # new message
         self.assertNotEqual(before.body, after.body)
 
+    def test_only_selected_groups_rendered(self):
+        """ Group options are loaded on demand except selected ones """
+        other = self.create_group()
+        broadcast = self.create_broadcast(when='future', groups=[self.group])
+        html = unicode(BroadcastForm(instance=broadcast)['groups'])
+        self.assertTrue(self.group.name in html)
+        self.assertFalse(other.name in html)
+
     def test_field_clearing(self):
         """ Non related frequency fields should be cleared on form clean """
         weekday = self.get_weekday_for_date(datetime.datetime.now())
@@ -227,6 +462,147 @@ class BroadcastViewTest(BroadcastCreateDataTest):
         self.user.save()
         self.client.login(username='test', password='abc')
 
+    def test_recipient_count(self):
+        """ The recipient count endpoint counts distinct contacts """
+        contact = self.create_contact()
+        g1 = self.create_group()
+        g2 = self.create_group()
+        contact.groups.add(g1, g2)
+        url = reverse('broadcast-recipient-count')
+        response = self.client.get(url, {'groups': [g1.pk, g2.pk]})
+        self.assertEqual(json.loads(response.content), {'count': 1})
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content), {'count': 0})
+
+    def test_broadcast_stats(self):
+        """ Delivery stats are available before anything is queued """
+        broadcast = self.create_broadcast()
+        url = reverse('broadcast-stats', args=[broadcast.pk])
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual(data['queued'], 0)
+        self.assertEqual(data['latency']['p50'], None)
+        BroadcastStats.objects.add_queued(broadcast.pk, 5)
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual((data['queued'], data['sent']), (5, 0))
+
+    def test_delivery_receipts(self):
+        """ Receipts update the status of sent messages in bulk """
+        broadcast = self.create_broadcast()
+        contact = self.create_contact()
+        messages = [broadcast.messages.create(
+            recipient=contact, status='sent', external_id=str(i))
+            for i in range(3)]
+        body = '\n'.join([
+            json.dumps({'id': '0', 'status': 'DELIVRD'}),
+            json.dumps({'id': '1', 'status': 'failed'}),
+            json.dumps({'id': '2', 'status': 'buffered'}),
+            json.dumps({'id': 'unknown', 'status': 'delivered'}),
+        ])
+        url = reverse('broadcast-delivery-receipts')
+        response = self.client.post(url, body,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(json.loads(response.content),
+                         {'delivered': 1, 'undelivered': 1, 'ignored': 2})
+        statuses = dict(BroadcastMessage.objects.values_list('external_id',
+                                                             'status'))
+        self.assertEqual(statuses, {'0': 'delivered', '1': 'undelivered',
+                                    '2': 'sent'})
+        self.assertTrue(BroadcastMessage.objects.get(
+            pk=messages[0].pk).date_delivered is not None)
+        # a late failure doesn't undo a delivery
+        response = self.client.post(url, '[{"id": "0", "status": "failed"}]',
+                                    content_type='application/json')
+        self.assertEqual(json.loads(response.content)['ignored'], 1)
+        response = self.client.post(url, '{"id"',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, '[]', content_type='application/json',
+                                    REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+    def test_archived_receipts(self):
+        """ Receipts of messages archived while waiting still apply """
+        broadcast = self.create_broadcast()
+        ArchivedBroadcastMessage.objects.create(
+            id=1000, broadcast=broadcast, recipient=self.create_contact(),
+            date_created=datetime.datetime.now(), status='sent',
+            external_id='abc')
+        url = reverse('broadcast-delivery-receipts')
+        response = self.client.post(url, '[{"id": "abc", "status": "ok"}, '
+                                    '{"id": "abc", "status": "delivrd"}]',
+                                    content_type='application/json')
+        self.assertEqual(json.loads(response.content),
+                         {'delivered': 1, 'undelivered': 0, 'ignored': 1})
+        self.assertEqual(ArchivedBroadcastMessage.objects.get(pk=1000).status,
+                         'delivered')
+
+    def test_group_search(self):
+        """ Groups are searched by name prefix, a page at a time """
+        for name in ('abc', 'abd', 'abe', 'xyz'):
+            self.create_group(name=name)
+        url = reverse('broadcast-group-search')
+        response = self.client.get(url, {'q': 'AB', 'limit': 2})
+        data = json.loads(response.content)
+        self.assertEqual([g['name'] for g in data['results']], ['abc', 'abd'])
+        self.assertTrue(data['more'])
+        response = self.client.get(url, {'q': 'ab', 'after': 'abd'})
+        data = json.loads(response.content)
+        self.assertEqual([g['name'] for g in data['results']], ['abe'])
+        self.assertFalse(data['more'])
+
+    def test_recent_messages(self):
+        """ Recent messages are cached per group until broadcasts change """
+        g1 = self.create_group()
+        g2 = self.create_group()
+        confirmations = self.create_group(name='Confirmations')
+        b1 = self.create_broadcast(when='future', groups=[g1], body='one')
+        self.create_broadcast(when='ready', groups=[g2], body='two')
+        self.create_broadcast(when='future', groups=[g1, confirmations],
+                              body='confirm')
+        url = reverse('broadcast-usage-recent-messages')
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['messages'],
+                         ['one', 'two'])
+        response = self.client.get(url, {'groups': [g1.pk, confirmations.pk]})
+        self.assertEqual(json.loads(response.content)['messages'],
+                         ['confirm', 'one'])
+        with self.assertNumQueries(0):
+            self.assertEqual(recent_bodies([g1]), ['one'])
+        response = self.client.get(url, {'groups': [g1.pk]},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, {'groups': [g1.pk]},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        b1.body = 'edited'
+        b1.save()
+        response = self.client.get(url, {'groups': [g1.pk]})
+        self.assertEqual(json.loads(response.content)['messages'],
+                         ['edited'])
+
+    def test_recent_messages_forwarded(self):
+        """ Forwarded broadcasts leave the recent messages cached """
+        group = self.create_group()
+        self.create_broadcast(when='future', groups=[group], body='one')
+        self.assertEqual(recent_bodies([group]), ['one'])
+        rule = self.create_forwarding_rule(dest=group)
+        forwarded = self.create_broadcast(forward=rule, groups=[group],
+                                          schedule_frequency=None)
+        forwarded.groups.add(self.create_group())
+        forwarded.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(recent_bodies([group]), ['one'])
+
+    def test_schedule(self):
+        """ The schedule shows recipient counts """
+        contact = self.create_contact()
+        group = self.create_group()
+        contact.groups.add(group)
+        self.create_broadcast(when='future', groups=[group])
+        response = self.client.get(reverse('broadcast-schedule'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '({0})'.format(1))
+
     def test_delete(self):
         """ Make sure broadcasts are disabled on 'delete' """
         contact = self.create_contact()
@@ -241,6 +617,331 @@ class BroadcastViewTest(BroadcastCreateDataTest):
         self.assertTrue(after.schedule_frequency is None)
 
 
+class MessageHistoryTest(BroadcastCreateDataTest):
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'a@b.com', 'abc')
+        self.user.save()
+        self.client.login(username='test', password='abc')
+        self.url = reverse('broadcast-messages')
+        contact = self.create_contact()
+        self.broadcast = self.create_broadcast()
+        self.messages = [self.broadcast.messages.create(recipient=contact)
+                         for i in range(25)]
+
+    def test_pages(self):
+        """ History is paged newest first by message id """
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        page = response.context['page']
+        ids = [m.pk for m in reversed(self.messages)]
+        self.assertEqual([m.pk for m in page['items']], ids[:20])
+        self.assertEqual(page['newer'], None)
+        self.assertEqual(page['older'], ids[19])
+        response = self.client.get(self.url, {'before': page['older']})
+        page = response.context['page']
+        self.assertEqual([m.pk for m in page['items']], ids[20:])
+        self.assertEqual(page['older'], None)
+        response = self.client.get(self.url, {'after': page['newer']})
+        page = response.context['page']
+        self.assertEqual([m.pk for m in page['items']], ids[:20])
+
+    def test_bounded_count(self):
+        """ History counts stop at BROADCAST_HISTORY_COUNT_LIMIT """
+        messages = BroadcastMessage.objects.filter(broadcast=self.broadcast)
+        with self.settings(BROADCAST_HISTORY_COUNT_LIMIT=10):
+            self.assertEqual(approximate_count(messages, True), (10, True))
+        with self.settings(BROADCAST_HISTORY_COUNT_LIMIT=100):
+            self.assertEqual(approximate_count(messages, True), (25, False))
+
+    def test_filters(self):
+        """ History can be filtered by broadcast and status """
+        self.messages[0].status = 'error'
+        self.messages[0].save()
+        response = self.client.get(self.url, {'status': 'error'})
+        page = response.context['page']
+        self.assertEqual([m.pk for m in page['items']], [self.messages[0].pk])
+        self.assertEqual(response.context['count'], 1)
+        other = self.create_broadcast()
+        response = self.client.get(self.url, {'broadcast': other.pk})
+        self.assertEqual(response.context['page']['items'], [])
+
+    def archive(self, messages):
+        """ Make messages old and sent, then archive them """
+        old = datetime.datetime.now() - relativedelta(days=100)
+        BroadcastMessage.objects.filter(pk__in=[m.pk for m in messages]) \
+                                .update(status='sent', date_created=old)
+        update_message_counts()
+        return archive_broadcast_messages(days=90)
+
+    def test_archived_history(self):
+        """ History reads the hot and archived messages in id order """
+        self.assertEqual(self.archive(self.messages[::2]), 13)
+        self.assertEqual(BroadcastMessage.objects.count(), 12)
+        self.test_pages()
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['count'], 25)
+        rows = list(export_rows([BroadcastMessage.objects.all(),
+                                 ArchivedBroadcastMessage.objects.all()],
+                                chunk_size=4))
+        self.assertEqual([row['id'] for row in rows],
+                         [m.pk for m in self.messages])
+
+    def test_archived_fields(self):
+        """ Archived messages keep their connection and delivery details """
+        message = self.messages[0]
+        connection = self.create_connection(contact=message.recipient)
+        BroadcastMessage.objects.filter(pk=message.pk).update(
+            connection=connection, external_id='abc', attempts=2,
+            date_delivered=datetime.datetime(2013, 1, 1))
+        self.assertEqual(self.archive([message]), 1)
+        archived = ArchivedBroadcastMessage.objects.get(pk=message.pk)
+        self.assertEqual((archived.connection, archived.external_id,
+                          archived.attempts, archived.date_delivered),
+                         (connection, 'abc', 2, datetime.datetime(2013, 1, 1)))
+
+    def test_export(self):
+        """ History is exported in chunks with the recipient's connection """
+        backend = self.create_backend(name='mockbackend')
+        recipient = self.messages[0].recipient
+        self.create_connection(contact=recipient, backend=backend)
+        rows = list(export_rows(BroadcastMessage.objects.all(), chunk_size=10))
+        self.assertEqual([row['id'] for row in rows],
+                         [m.pk for m in self.messages])
+        self.assertEqual(rows[0]['backend'], 'mockbackend')
+        self.assertEqual(rows[0]['recipient_name'], recipient.name)
+        # the connection a message was queued to wins over newer ones
+        queued_to = self.create_connection(
+            contact=recipient, backend=self.create_backend(name='old'))
+        BroadcastMessage.objects.filter(pk=self.messages[0].pk).update(
+            connection=queued_to)
+        self.create_connection(contact=recipient, backend=backend)
+        rows = list(export_rows(BroadcastMessage.objects.all()))
+        self.assertEqual((rows[0]['identity'], rows[0]['backend']),
+                         (queued_to.identity, 'old'))
+        self.assertEqual(rows[1]['backend'], 'mockbackend')
+        url = reverse('broadcast-messages-export')
+        response = self.client.get(url, {'status': 'queued'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = response.content.splitlines()
+        self.assertEqual(len(lines), 26)
+        self.assertTrue(lines[0].startswith('id,broadcast,body'))
+        response = self.client.get(url, {'format': 'jsonl', 'status': 'error'})
+        self.assertEqual(response.content, '')
+
+
+class ReportGraphDataTest(BroadcastCreateDataTest):
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'a@b.com', 'abc')
+        self.user.save()
+        self.client.login(username='test', password='abc')
+        self.connection = self.create_connection()
+        self.url = reverse('broadcast-usage-graph-data')
+
+    def create_message(self, date, direction):
+        return Message.objects.create(connection=self.connection, date=date,
+                                      direction=direction,
+                                      text=self.random_string(20))
+
+    def test_monthly_counts(self):
+        """ Messages should be counted per month and direction """
+        today = datetime.date.today()
+        this_month = datetime.datetime(today.year, today.month, 1, 12)
+        last_month = this_month - relativedelta(months=1)
+        self.create_message(this_month, 'I')
+        self.create_message(this_month, 'O')
+        self.create_message(this_month, 'O')
+        self.create_message(last_month, 'I')
+        update_message_counts()
+        response = self.client.get(self.url)
+        data = json.loads(response.content)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0], [today.isoformat(), 1, 2])
+        self.assertEqual(data[1][1:], [1, 0])
+        self.assertEqual(data[2][1:], [0, 0])
+
+    def test_number_of_months(self):
+        """ The number of months can be chosen without adding queries """
+        with self.assertNumQueries(1):
+            data = monthly_message_counts(datetime.date.today(), 24)
+        self.assertEqual(len(data), 24)
+        response = self.client.get(self.url, {'months': 3})
+        self.assertEqual(len(json.loads(response.content)), 3)
+
+    def test_conditional_get(self):
+        """ Unchanged graph data is answered with 304 Not Modified """
+        self.create_message(datetime.datetime.now(), 'I')
+        update_message_counts()
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # runs which count nothing new don't change the response
+        update_message_counts()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.create_message(datetime.datetime.now(), 'I')
+        update_message_counts()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_incremental_counts(self):
+        """ Messages should only be counted once across updates """
+        today = datetime.date.today()
+        self.create_message(datetime.datetime.now(), 'I')
+        update_message_counts()
+        self.create_message(datetime.datetime.now(), 'I')
+        self.create_message(datetime.datetime.now(), 'O')
+        update_message_counts()
+        update_message_counts()
+        totals = DailyMessageCount.objects.totals(today, today)
+        self.assertEqual(totals, (2, 1))
+
+    def test_count_lag(self):
+        """ Messages are only counted once they are older than the lag """
+        today = datetime.date.today()
+        self.create_message(datetime.datetime.now(), 'I')
+        with self.settings(BROADCAST_COUNT_LAG_SECONDS=3600):
+            update_message_counts()
+        self.assertEqual(DailyMessageCount.objects.totals(today, today),
+                         (0, 0))
+        mark = HighWaterMark.objects.get(name='messagelog')
+        self.assertEqual(mark.last_id, 0)
+        self.assertTrue(mark.date_updated < datetime.datetime.now() -
+                        relativedelta(minutes=59))
+        update_message_counts()
+        self.assertEqual(DailyMessageCount.objects.totals(today, today),
+                         (1, 0))
+
+    def test_closed_period_time_zone(self):
+        """ Closed periods are found with time zone support on """
+        with self.settings(USE_TZ=True):
+            HighWaterMark.objects.create(name='messagelog',
+                                         date_updated=timezone.now())
+            yesterday = timezone.localtime(timezone.now()).date() - \
+                relativedelta(days=1)
+            self.assertTrue(is_closed_period(yesterday))
+            self.assertFalse(is_closed_period(yesterday +
+                                              relativedelta(days=1)))
+
+    def test_closed_report_cached(self):
+        """ Reports of closed periods should be served from the cache """
+        today = datetime.date.today()
+        start_date = today - relativedelta(months=1, day=1)
+        end_date = today - relativedelta(day=1, days=1)
+        date = datetime.datetime.combine(start_date, datetime.time(12))
+        self.create_message(date, 'I')
+        update_message_counts()
+        context = cached_usage_report_context(start_date, end_date)
+        self.assertEqual(context['incoming_count'], 1)
+        self.create_message(date, 'I')
+        update_message_counts()
+        with self.assertNumQueries(1):
+            context = cached_usage_report_context(start_date, end_date)
+        self.assertEqual(context['incoming_count'], 1)
+        # changing forwarding rules invalidates cached reports
+        self.create_forwarding_rule(rule_type='a', label='b')
+        context = cached_usage_report_context(start_date, end_date)
+        self.assertEqual(context['incoming_count'], 2)
+
+
+class UsageReportTest(BroadcastCreateDataTest):
+
+    def create_forwarded(self, rule, recipients):
+        broadcast = self.create_broadcast(forward=rule,
+                                          schedule_frequency='one-time')
+        for contact in recipients:
+            broadcast.messages.create(recipient=contact)
+        return broadcast
+
+    def test_rule_data(self):
+        """ Forwarded broadcasts and messages are counted by type and label """
+        contacts = [self.create_contact() for i in range(3)]
+        r1 = self.create_forwarding_rule(rule_type='Staff', label='To Staff')
+        r2 = self.create_forwarding_rule(rule_type='Staff', label='To Staff')
+        r3 = self.create_forwarding_rule(rule_type='Staff', label='Other')
+        self.create_forwarding_rule(rule_type='Cold Chain', label='Alerts')
+        self.create_forwarding_rule(rule_type='', label='Unnamed')
+        self.create_forwarded(r1, contacts)
+        self.create_forwarded(r2, contacts[:1])
+        self.create_forwarded(r3, [])
+        update_message_counts()
+        today = datetime.date.today()
+        context = usage_report_context(today, today + relativedelta(days=1))
+        self.assertEqual(context['rule_data'], {
+            'Staff': {'To Staff': [2, 4], 'Other': [1, 0]},
+            'Cold Chain': {'Alerts': [0, 0]},
+        })
+
+    def test_archived_messages(self):
+        """ Archived messages still count towards their rule """
+        contacts = [self.create_contact() for i in range(3)]
+        rule = self.create_forwarding_rule(rule_type='Staff', label='Alerts')
+        broadcast = self.create_forwarded(rule, contacts)
+        old = datetime.datetime.now() - relativedelta(days=100)
+        broadcast.messages.update(status='sent', date_created=old)
+        update_message_counts()
+        self.assertEqual(archive_broadcast_messages(days=90), 3)
+        today = datetime.date.today()
+        context = usage_report_context(today, today + relativedelta(days=1))
+        self.assertEqual(context['rule_data'], {'Staff': {'Alerts': [1, 3]}})
+
+    def test_constant_queries(self):
+        """ The number of queries doesn't depend on rules or broadcasts """
+        today = datetime.date.today()
+        end_date = today + relativedelta(days=1)
+        with self.assertNumQueries(4):
+            usage_report_context(today, end_date)
+        contact = self.create_contact()
+        for i in range(5):
+            rule = self.create_forwarding_rule(rule_type=str(i), label='a')
+            self.create_forwarded(rule, [contact])
+        update_message_counts()
+        with self.assertNumQueries(4):
+            usage_report_context(today, end_date)
+
+    def test_stored_report(self):
+        """ Stored reports are emailed and shown without recomputing """
+        month = last_month()
+        rule = self.create_forwarding_rule(rule_type='Staff', label='Alerts')
+        report = build_usage_report(month)
+        self.assertEqual(report.month, month)
+        self.assertEqual(report.get_context()['rule_data'],
+                         {'Staff': {'Alerts': [0, 0]}})
+        group = Group.objects.create(name='Monthly Report')
+        group.contacts.add(self.create_contact(email='a@b.com'),
+                           self.create_contact(email=''))
+        usage_email_callback(None)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['a@b.com'])
+        self.assertEqual(mail.outbox[0].subject, report.subject)
+        self.assertTrue(UsageReport.objects.get(pk=report.pk).date_sent)
+        rule.delete()
+        User.objects.create_user('test', 'a@b.com', 'abc')
+        self.client.login(username='test', password='abc')
+        response = self.client.get(reverse('broadcast-dashboard'), {
+            'report_year': month.year, 'report_month': month.month})
+        self.assertEqual(response.context['rule_data'],
+                         {'Staff': {'Alerts': [0, 0]}})
+
+    def test_report_not_built(self):
+        """ Reports built when emailed are only stored once counts are final """
+        group = Group.objects.create(name='Monthly Report')
+        group.contacts.add(self.create_contact(email='a@b.com'))
+        # counts lag behind the end of last month
+        with override_settings(BROADCAST_COUNT_LAG_SECONDS=32 * 24 * 3600):
+            usage_email_callback(None)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(UsageReport.objects.exists())
+        usage_email_callback(None)
+        self.assertEqual(len(mail.outbox), 2)
+        report = UsageReport.objects.get(month=last_month())
+        self.assertTrue(report.date_sent)
+
+
 class BroadcastForwardingTest(BroadcastCreateDataTest):
 
     def setUp(self):
@@ -344,6 +1045,103 @@ class BroadcastScriptedTest(BroadcastCreateDataTest):
         self.assertEquals(message.status, 'sent')
         self.assertTrue(message.date_sent is not None)
 
+    def test_metrics(self):
+        """ The scheduler keeps pipeline metrics up to date """
+        backend = self.create_backend(name='mockbackend')
+        group = self.create_group()
+        for i in range(3):
+            contact = self.create_contact()
+            self.create_connection(contact=contact, backend=backend)
+            contact.groups.add(group)
+        self.create_contact().groups.add(group)
+        self.create_broadcast(when='ready', groups=[group])
+        scheduler_callback()
+        response = self.client.get(reverse('broadcast-metrics'))
+        lines = response.content.splitlines()
+        self.assertTrue('broadcast_messages_queued_total 3' in lines)
+        self.assertTrue('broadcast_queue_depth 0' in lines)
+        self.assertTrue('broadcast_messages_sent_total{backend="mockbackend"} 3'
+                        in lines)
+        self.assertTrue('broadcast_messages_errors_total{backend="none"} 1'
+                        in lines)
+        self.assertTrue('broadcast_fanout_size_bucket{le="10"} 1' in lines)
+        self.assertTrue('broadcast_stage_runs_total{stage="send"} 1' in lines)
+        response = self.client.get(reverse('broadcast-metrics'),
+                                   REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+    def test_oldest_queued(self):
+        """ The oldest queued message is found across all broadcasts """
+        contact = self.create_contact()
+        b1 = self.create_broadcast(when='future')
+        b2 = self.create_broadcast(when='future')
+        date = datetime.datetime(2012, 1, 1, 12, 0)
+        old = b2.messages.create(recipient=contact)
+        BroadcastMessage.objects.filter(pk=old.pk).update(date_created=date)
+        b1.messages.create(recipient=contact)
+        b1.messages.create(recipient=contact, status='sent')
+        update_queue_metrics()
+        self.assertEqual(metrics.get('oldest_queued_timestamp'),
+                         time.mktime(date.timetuple()))
+
+    def test_slow_tick_log(self):
+        """ Slow ticks are logged with the stage and broadcast to blame """
+        contact = self.create_contact()
+        self.create_connection(contact=contact,
+                               backend=self.create_backend(name='mockbackend'))
+        group = self.create_group()
+        contact.groups.add(group)
+        broadcast = self.create_broadcast(when='ready', groups=[group])
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        slow_logger = logging.getLogger('broadcast.slowlog')
+        slow_logger.addHandler(handler)
+        try:
+            with self.settings(BROADCAST_SLOW_TICK_SECONDS=0):
+                scheduler_callback()
+        finally:
+            slow_logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        profile = records[0].profile
+        self.assertEqual(profile['tick'], 'scheduler_callback')
+        stages = dict([((s['stage'], s['broadcast']), s)
+                       for s in profile['stages']])
+        self.assertEqual(stages[('fan_out', broadcast.pk)]['calls'], 1)
+        self.assertTrue(stages[('fan_out', broadcast.pk)]['queries'] > 0)
+        self.assertEqual(stages[('backend_send', broadcast.pk)]['calls'], 1)
+
+
+    def test_compact_recipients(self):
+        """ Compact mode stores one snapshot and only failures as rows """
+        backend = self.create_backend(name='mockbackend')
+        group = self.create_group()
+        for i in range(3):
+            contact = self.create_contact()
+            self.create_connection(contact=contact, backend=backend)
+            contact.groups.add(group)
+        unreachable = self.create_contact()
+        unreachable.groups.add(group)
+        broadcast = self.create_broadcast(when='ready', groups=[group])
+        with self.settings(BROADCAST_COMPACT_RECIPIENTS=True):
+            scheduler_callback()
+        snapshot = RecipientSnapshot.objects.get(broadcast=broadcast)
+        self.assertEqual(list(snapshot.get_recipients()),
+                         sorted(group.contacts.values_list('pk', flat=True)))
+        self.assertEqual((snapshot.size, snapshot.position), (4, 4))
+        self.assertEqual(snapshot.exception_rows, 1)
+        self.assertFalse(snapshot.claims.exists())
+        message = BroadcastMessage.objects.get(broadcast=broadcast)
+        self.assertEqual((message.recipient, message.status),
+                         (unreachable, 'unreachable'))
+        stats = BroadcastStats.objects.get(broadcast=broadcast)
+        self.assertEqual((stats.queued, stats.sent, stats.errors), (0, 3, 1))
+        # sent recipients are counted when sent, failures when rolled up
+        update_message_counts()
+        counts = DailyMessageCount.objects.filter(source='broadcast',
+                                                  broadcast=broadcast)
+        self.assertEqual(sum(counts.values_list('count', flat=True)), 4)
+
 
 class ForwardingViewsTest(BroadcastCreateDataTest):
 
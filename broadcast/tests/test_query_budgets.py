@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+import datetime
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+
+from rapidsms.contrib.messagelog.models import Message
+from rapidsms.messages.incoming import IncomingMessage
+from rapidsms.router import get_router
+from rapidsms.tests.harness import MockRouter, MockBackend
+
+from broadcast.app import (BroadcastApp, queue_outgoing_messages,
+    scheduler_callback, send_queued_messages, update_message_counts)
+from broadcast.tests.base import BroadcastCreateDataTest, QueryBudgetMixin
+
+
+class QueryBudgetTest(QueryBudgetMixin, BroadcastCreateDataTest):
+    """
+    Hot paths must make a fixed number of queries, whatever the number of
+    rules, broadcasts, messages or contacts involved.
+    """
+
+    def setUp(self):
+        User.objects.create_user('test', 'a@b.com', 'abc')
+        self.client.login(username='test', password='abc')
+        self.backend = self.create_backend(name='mockbackend')
+
+    def create_members(self, group, count):
+        for i in range(count):
+            contact = self.create_contact()
+            self.create_connection(contact=contact, backend=self.backend)
+            contact.groups.add(group)
+
+    def test_queue_outgoing_messages(self):
+        """ Queueing a broadcast doesn't query per recipient """
+        def grow(size):
+            group = self.create_group()
+            self.create_members(group, size)
+            self.create_broadcast(when='ready', groups=[group])
+
+        self.assertQueryScaling(15, grow, queue_outgoing_messages,
+                                warm_up=False)
+
+    def test_send_queued_messages(self):
+        """
+        Sending costs one UPDATE per message, plus the INSERT of the
+        message log when the router sends it
+        """
+        get_router()(backends={'mockbackend': {'ENGINE': MockBackend}})
+
+        def grow(size):
+            group = self.create_group()
+            self.create_members(group, size)
+            self.create_broadcast(when='ready', groups=[group])
+            queue_outgoing_messages()
+
+        self.assertQueryScaling(12, grow, send_queued_messages, per_row=2,
+                                warm_up=False)
+
+    def test_scheduler_callback(self):
+        """
+        A whole tick costs no more per message than sending does: queueing
+        and the queue metrics are constant
+        """
+        get_router()(backends={'mockbackend': {'ENGINE': MockBackend}})
+
+        def grow(size):
+            group = self.create_group()
+            self.create_members(group, size)
+            self.create_broadcast(when='ready', groups=[group])
+
+        self.assertQueryScaling(30, grow, scheduler_callback, per_row=2,
+                                warm_up=False)
+
+    def test_forwarding(self):
+        """ Forwarding doesn't depend on the number of rules or recipients """
+        app = BroadcastApp(router=MockRouter())
+        rule = self.create_forwarding_rule(keyword='abc')
+        contact = self.create_contact()
+        conn = self.create_connection(contact=contact, backend=self.backend)
+        rule.source.contacts.add(contact)
+
+        def grow(size):
+            for i in range(size):
+                self.create_forwarding_rule()
+            self.create_members(rule.dest, size)
+
+        def handle():
+            app.handle(IncomingMessage(conn, u'abc hello'))
+
+        self.assertQueryScaling(15, grow, handle)
+
+    def test_schedule(self):
+        """ The schedule page doesn't query per broadcast """
+        def grow(size):
+            for i in range(size):
+                group = self.create_group()
+                self.create_members(group, 1)
+                self.create_broadcast(when='future', groups=[group])
+
+        url = reverse('broadcast-schedule')
+        # with a cold cache, each new broadcast's recipients are counted once
+        self.assertQueryScaling(12, grow, lambda: self.client.get(url),
+                                per_row=1, warm_up=False)
+
+    def test_schedule_membership_change(self):
+        """ A membership change only recounts the recipients of its group """
+        groups = []
+        for i in range(10):
+            group = self.create_group()
+            self.create_members(group, 1)
+            self.create_broadcast(when='future', groups=[group])
+            groups.append(group)
+        url = reverse('broadcast-schedule')
+        self.client.get(url)
+        warm = self.count_queries(self.client.get, url)
+        self.create_members(groups[0], 1)
+        self.assertQueryBudget(warm + 1, self.client.get, url)
+
+    def test_list_messages(self):
+        """ The message history page doesn't query per message """
+        broadcast = self.create_broadcast()
+
+        def grow(size):
+            for i in range(size):
+                broadcast.messages.create(recipient=self.create_contact())
+
+        url = reverse('broadcast-messages')
+        self.assertQueryScaling(10, grow, lambda: self.client.get(url))
+
+    def test_dashboard(self):
+        """ The dashboard doesn't query per rule or broadcast """
+        def grow(size):
+            for i in range(size):
+                rule = self.create_forwarding_rule(rule_type='Type',
+                                                   label=str(i))
+                broadcast = self.create_broadcast(
+                    forward=rule, schedule_frequency='one-time')
+                broadcast.messages.create(recipient=self.create_contact())
+
+        url = reverse('broadcast-dashboard')
+        self.assertQueryScaling(10, grow, lambda: self.client.get(url))
+
+    def test_report_graph_data(self):
+        """ The graph data doesn't depend on the number of messages """
+        conn = self.create_connection(backend=self.backend)
+
+        def grow(size):
+            for i in range(size):
+                Message.objects.create(connection=conn, direction='I',
+                                       date=datetime.datetime.now(),
+                                       text=self.random_string(10))
+            update_message_counts()
+
+        url = reverse('broadcast-usage-graph-data')
+        self.assertQueryScaling(10, grow, lambda: self.client.get(url))
@@ -18,9 +18,18 @@ urlpatterns = patterns('',
     url(r'^schedule/(?P<broadcast_id>\d+)/delete/$', views.delete_broadcast,
         name='delete-broadcast'),
 
+    url(r'^schedule/(?P<broadcast_id>\d+)/stats/$', views.broadcast_stats,
+        name='broadcast-stats'),
+
     url(r'^messages/$', views.list_messages,
         name='broadcast-messages'),
 
+    url(r'^messages/export/$', views.export_messages,
+        name='broadcast-messages-export'),
+
+    url(r'^messages/receipts/$', views.delivery_receipts,
+        name='broadcast-delivery-receipts'),
+
     url(r'^forwarding/$', views.forwarding,
         name='broadcast-forwarding'),
 
@@ -39,6 +48,15 @@ urlpatterns = patterns('',
     url('^message-data/$', views.last_messages,
         name='broadcast-usage-recent-messages'),
 
+    url('^recipients/$', views.recipients,
+        name='broadcast-recipient-count'),
+
+    url('^groups/$', views.group_search,
+        name='broadcast-group-search'),
+
     url('^dashboard/$', views.dashboard,
         name='broadcast-dashboard'),
+
+    url('^metrics/$', views.metrics_text,
+        name='broadcast-metrics'),
 )
@@ -2,23 +2,37 @@
 # vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
 import calendar
 import datetime
+import hashlib
 
-from django.db import transaction
+from django.db import connection, transaction
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import (HttpResponseRedirect, HttpResponse,
+    HttpResponseBadRequest, HttpResponseForbidden)
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Q
+from django.db.models import Count, Q, Sum
 from django.shortcuts import get_object_or_404
 from django.utils import simplejson as json
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
 
-from rapidsms.contrib.messagelog.models import Message
+from rapidsms.models import Backend
+
+from groups.models import Group
 
 from broadcast.forms import (BroadcastForm, ForwardingRuleForm, ReportForm,
-    RecentMessageForm)
-from broadcast.models import Broadcast, BroadcastMessage, ForwardingRule
+    GraphDataForm, MessageFilterForm, RecentMessageForm)
+from broadcast import caching, metrics
+from broadcast.export import FORMATS, export_lines
+from broadcast.receipts import apply_receipts, parse_body
+from broadcast.models import (ArchivedBroadcastMessage, Broadcast,
+    BroadcastMessage, BroadcastStats, ForwardingRule, DailyMessageCount,
+    HighWaterMark, UsageReport, recent_bodies, recent_broadcasts_modified,
+    recipient_count)
 
 
 @login_required
@@ -65,20 +79,222 @@ def delete_broadcast(request, broadcast_id):
 @login_required
 def schedule(request):
     broadcasts = Broadcast.objects.exclude(schedule_frequency__isnull=True)
-    broadcasts = broadcasts.annotate(recipients=Count('groups__contacts', distinct=True))
+    # recipient counts are cached per group set, see Broadcast.recipient_count
+    broadcasts = broadcasts.prefetch_related('groups').select_related('stats')
     return render(request, 'broadcast/schedule.html', {
         'broadcasts': broadcasts.order_by('date'),
     })
 
 
+@login_required
+def broadcast_stats(request, broadcast_id):
+    """ Delivery counters and latencies of a broadcast """
+    broadcast = get_object_or_404(Broadcast, pk=broadcast_id)
+    try:
+        stats = broadcast.stats
+    except BroadcastStats.DoesNotExist:
+        stats = BroadcastStats(broadcast=broadcast)
+    return HttpResponse(json.dumps(stats.as_dict()),
+                        mimetype='application/json')
+
+
+def metrics_text(request):
+    """
+    Pipeline metrics in the Prometheus text format, for clients in
+    BROADCAST_METRICS_ALLOWED_IPS (by default only localhost).
+    """
+    allowed = getattr(settings, 'BROADCAST_METRICS_ALLOWED_IPS',
+                      ('127.0.0.1',))
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    backends = dict(Backend.objects.values_list('pk', 'name'))
+    return HttpResponse(metrics.render(backends),
+                        mimetype='text/plain; version=0.0.4')
+
+
+@csrf_exempt
+@require_POST
+def delivery_receipts(request):
+    """
+    Applies a batch of delivery receipts, posted as JSON lines or a JSON
+    list of {"id": ..., "status": ...} objects by clients in
+    BROADCAST_DLR_ALLOWED_IPS (by default only localhost).
+    """
+    allowed = getattr(settings, 'BROADCAST_DLR_ALLOWED_IPS', ('127.0.0.1',))
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    try:
+        receipts = list(parse_body(request.body))
+    except ValueError, e:
+        return HttpResponseBadRequest(unicode(e))
+    counts = apply_receipts(receipts)
+    return HttpResponse(json.dumps(counts), mimetype='application/json')
+
+
+@login_required
+def recipients(request):
+    """ Number of contacts a broadcast to the given groups would reach """
+    try:
+        group_ids = [int(pk) for pk in request.GET.getlist('groups')]
+    except ValueError:
+        group_ids = []
+    data = {'count': recipient_count(group_ids)}
+    return HttpResponse(json.dumps(data), mimetype='application/json')
+
+
+@login_required
+def group_search(request):
+    """
+    Groups whose name starts with 'q', in name order, 'limit' at a time.
+    Pass the last name returned as 'after' to get the next results.
+    """
+    query = request.GET.get('q', u'').strip()
+    after = request.GET.get('after')
+    limit = _positive_int(request.GET.get('limit')) or 20
+    limit = min(limit, 100)
+    groups = Group.objects.order_by('name')
+    if query:
+        # uses an expression index on PostgreSQL, see migration 0015
+        groups = groups.filter(name__istartswith=query)
+    if after:
+        groups = groups.filter(name__gt=after)
+    groups = list(groups.values('id', 'name')[:limit + 1])
+    data = {
+        'results': groups[:limit],
+        'more': len(groups) > limit,
+    }
+    return HttpResponse(json.dumps(data), mimetype='application/json')
+
+
 @login_required
 def list_messages(request):
-    messages = BroadcastMessage.objects.select_related()
+    form = MessageFilterForm(request.GET or None)
+    # old messages are moved to the archive, history shows both
+    tables = [BroadcastMessage.objects.all(),
+              ArchivedBroadcastMessage.objects.all()]
+    filtered = False
+    if form.is_valid():
+        tables = [form.filter(messages) for messages in tables]
+        filtered = form.is_filtered()
+    counts = [approximate_count(messages, filtered) for messages in tables]
+    count = sum([c for c, approximate in counts])
+    approximate = True in [approximate for c, approximate in counts]
+    # only join and load what the template shows
+    tables = [messages.select_related(
+        'broadcast', 'recipient',
+    ).only(
+        'date_created', 'date_sent', 'status', 'broadcast__body',
+        'recipient__name',
+    ) for messages in tables]
+    page = keyset_page(tables, request, per_page=20)
+    query = request.GET.copy()
+    for key in ('before', 'after'):
+        query.pop(key, None)
     return render(request, 'broadcast/messages.html', {
-        'broadcast_messages': messages,
+        'filter_form': form,
+        'broadcast_messages': page['items'],
+        'page': page,
+        'count': count,
+        'approximate_count': approximate,
+        'filter_query': query.urlencode(),
     })
 
 
+@login_required
+def export_messages(request):
+    """
+    Streams the message history, filtered like list_messages, as CSV or
+    as JSON lines (?format=jsonl). The export is written as it is read, so
+    the response must not pass through middleware which reads the whole
+    content, such as GZipMiddleware or ETag generation.
+    """
+    form = MessageFilterForm(request.GET or None)
+    tables = [BroadcastMessage.objects.all(),
+              ArchivedBroadcastMessage.objects.all()]
+    if form.is_valid():
+        tables = [form.filter(messages) for messages in tables]
+    format = request.GET.get('format')
+    if format not in FORMATS:
+        format = 'csv'
+    response = HttpResponse(export_lines(tables, format),
+                            mimetype=FORMATS[format])
+    filename = 'broadcast-messages.{0}'.format(format)
+    response['Content-Disposition'] = 'attachment; filename={0}'.format(
+        filename)
+    return response
+
+
+def keyset_page(querysets, request, per_page):
+    """
+    Returns one page of querysets, newest first, starting after the
+    'before' or 'after' id in the request. Several querysets of models
+    sharing ids, such as messages and archived messages, are merged in id
+    order. The page also includes the ids to pass as 'before' or 'after'
+    to get the next older or newer page, if any. Unlike OFFSET based
+    pagination, every page costs the same to fetch.
+    """
+    if not isinstance(querysets, (list, tuple)):
+        querysets = [querysets]
+    before = _positive_int(request.GET.get('before'))
+    after = _positive_int(request.GET.get('after'))
+    items = []
+    if after:
+        for queryset in querysets:
+            queryset = queryset.filter(pk__gt=after).order_by('pk')
+            items.extend(queryset[:per_page + 1])
+        items.sort(key=lambda item: item.pk)
+        has_newer = len(items) > per_page
+        items = items[:per_page]
+        items.reverse()
+        has_older = True
+    else:
+        for queryset in querysets:
+            if before:
+                queryset = queryset.filter(pk__lt=before)
+            items.extend(queryset.order_by('-pk')[:per_page + 1])
+        items.sort(key=lambda item: item.pk, reverse=True)
+        has_older = len(items) > per_page
+        items = items[:per_page]
+        has_newer = bool(before)
+    return {
+        'items': items,
+        'older': items and has_older and items[-1].pk or None,
+        'newer': items and has_newer and items[0].pk or None,
+    }
+
+
+def _positive_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value > 0 and value or None
+
+
+def approximate_count(queryset, filtered):
+    """
+    Returns a tuple of (count, approximate) for queryset. The statistics
+    of PostgreSQL are used for unfiltered tables, other counts stop at
+    BROADCAST_HISTORY_COUNT_LIMIT rows (default 10000).
+    """
+    limit = getattr(settings, 'BROADCAST_HISTORY_COUNT_LIMIT', 10000)
+    if not filtered and connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[0] > limit:
+            return int(row[0]), True
+    # count() would drop the slice and count every row, so count a
+    # bounded subquery instead
+    bounded = queryset.order_by().values('pk')[:limit + 1]
+    sql, params = bounded.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM ({0}) bounded'.format(sql), params)
+    count = cursor.fetchone()[0]
+    return min(count, limit), count > limit
+
+
 @login_required
 def forwarding(request):
     return render(request, 'broadcast/forwarding.html', {
@@ -130,48 +346,84 @@ def dashboard(request):
         report_date = datetime.date(report_year, report_month, last_day)
     start_date = datetime.date(report_date.year, report_date.month, 1)
     end_date = report_date
-    context = usage_report_context(start_date, end_date)
+    try:
+        # past months are read from the report built when they ended
+        context = UsageReport.objects.get(month=start_date).get_context()
+    except UsageReport.DoesNotExist:
+        context = cached_usage_report_context(start_date, end_date)
     context['report_date'] = report_date
     context['report_form'] = form
     return render(request, 'broadcast/dashboard.html', context)
 
 
+def cached_usage_report_context(start_date, end_date):
+    """
+    Cached usage_report_context(). Reports of periods which ended before
+    the message counts were last updated can't change anymore and are
+    cached indefinitely; other reports are cached for
+    BROADCAST_REPORT_CACHE_TIMEOUT seconds (default 60).
+    """
+    key = 'broadcast:report:{0}:{1}:{2}'.format(
+        caching.get_version('report'), start_date.isoformat(),
+        end_date.isoformat())
+    if is_closed_period(end_date):
+        timeout = caching.FOREVER
+    else:
+        timeout = getattr(settings, 'BROADCAST_REPORT_CACHE_TIMEOUT', 60)
+    compute = lambda: usage_report_context(start_date, end_date)
+    # copy so callers can add to the context without changing the cache
+    return dict(caching.get_or_compute(key, compute, timeout))
+
+
+def is_closed_period(end_date):
+    """
+    Returns True if the message counts were updated after end_date, so
+    reports ending on that date are final.
+    """
+    next_day = datetime.datetime.combine(end_date, datetime.time()) + \
+        datetime.timedelta(days=1)
+    if settings.USE_TZ:
+        next_day = timezone.make_aware(next_day,
+                                       timezone.get_current_timezone())
+    return HighWaterMark.objects.filter(name='messagelog',
+                                        date_updated__gte=next_day).exists()
+
+
 def usage_report_context(start_date, end_date):
     # Get forwarding rule data
     named_rules = ForwardingRule.objects.filter(
         ~Q(Q(label__isnull=True) | Q(label=u"")),
         ~Q(Q(rule_type__isnull=True) | Q(rule_type=u"")),
     )
-    # This count includes all queued, sent and error messages from this broadcast
-    broadcasts = Broadcast.objects.filter(
+    rule_data = {}
+    for rule_type, label in named_rules.values_list('rule_type', 'label'):
+        rule_data.setdefault(rule_type, {})[label] = [0, 0]
+    usage = Broadcast.objects.filter(
         date_created__range=(start_date, end_date),
         schedule_frequency='one-time',
         forward__in=named_rules
-    ).select_related('rule').annotate(message_count=Count('messages'))
-    rule_data = {}
-    for rule in named_rules:
-        data = rule_data.get(rule.rule_type, {})
-        label_data = data.get(rule.label, [0, 0])
-        data[rule.label] = label_data
-        rule_data[rule.rule_type] = data
-    for broadcast in broadcasts:
-        rule = broadcast.forward
-        data = rule_data.get(rule.rule_type, {})
-        label_data = data.get(rule.label, [0, 0])
-        label_data[0] += 1
-        label_data[1] += broadcast.message_count
-        data[rule.label] = label_data
-        rule_data[rule.rule_type] = data
+    ).values('forward__rule_type', 'forward__label').annotate(
+        broadcast_count=Count('id'),
+    ).order_by()
+    for row in usage:
+        label_data = rule_data[row['forward__rule_type']]
+        label_data[row['forward__label']][0] = row['broadcast_count']
+    # Messages, including archived ones and compact mode recipients, come
+    # from the daily counts rather than the message tables
+    counts = DailyMessageCount.objects.filter(
+        source='broadcast',
+        date__range=(start_date, end_date),
+        rule__in=named_rules
+    ).values('rule__rule_type', 'rule__label').annotate(
+        message_count=Sum('count'),
+    ).order_by()
+    for row in counts:
+        label_data = rule_data[row['rule__rule_type']]
+        label_data[row['rule__label']][1] = row['message_count']
 
     # Get total incoming/outgoing data
-    incoming_count = Message.objects.filter(
-        date__range=(start_date, end_date),
-        direction='I'
-    ).count()
-    outgoing_count = Message.objects.filter(
-        date__range=(start_date, end_date),
-        direction='O'
-    ).count()
+    incoming_count, outgoing_count = DailyMessageCount.objects.totals(
+        start_date, end_date)
     total_messages = incoming_count + outgoing_count
 
     context = {
@@ -183,74 +435,101 @@ def usage_report_context(start_date, end_date):
     return context
 
 
+def monthly_message_counts(report_date, months):
+    """
+    Returns a list of [end_date, incoming, outgoing] rows for the given
+    number of months, newest first, ending with the month of report_date.
+    All months are read from the daily counts with a single grouped query.
+    """
+    periods = []
+    year, month = report_date.year, report_date.month
+    for i in range(months):
+        last_day = calendar.monthrange(year, month)[1]
+        periods.append((datetime.date(year, month, 1),
+                        datetime.date(year, month, last_day)))
+        month -= 1
+        if month <= 0:
+            month += 12
+            year -= 1
+    totals = DailyMessageCount.objects.monthly_totals(periods[-1][0],
+                                                      periods[0][1])
+    data = []
+    for start_date, end_date in periods:
+        row = [end_date.isoformat(), totals.get((start_date, 'I'), 0),
+               totals.get((start_date, 'O'), 0)]
+        data.append(row)
+    # the current month is reported up to the report date
+    data[0][0] = report_date.isoformat()
+    return data
+
+
+def _query_etag(request, version):
+    """ ETag for a response depending on the query string and a version """
+    params = sorted([(k, v) for k, v in request.GET.iterlists()
+                     if k != 'timestamp'])
+    return hashlib.md5(repr((params, version))).hexdigest()
+
+
+def report_graph_etag(request):
+    try:
+        last_id = HighWaterMark.objects.get(name='messagelog').last_id
+    except HighWaterMark.DoesNotExist:
+        last_id = None
+    # the date is included since the current month is labelled with it.
+    # There is no Last-Modified: the mark's date moves on every run of the
+    # counts, and browsers only get a 304 if both validators match.
+    version = (last_id, datetime.date.today())
+    return _query_etag(request, version)
+
+
 @login_required
+@condition(etag_func=report_graph_etag)
 def report_graph_data(request):
     today = datetime.date.today()
     report_date = today
     initial = {'report_year': report_date.year, 'report_month': report_date.month}
-    form = ReportForm(request.GET or None, initial=initial)
+    form = GraphDataForm(request.GET or None, initial=initial)
+    months = getattr(settings, 'BROADCAST_GRAPH_MONTHS', 7)
     if form.is_valid():
         report_year = form.cleaned_data.get('report_year') or report_date.year
         report_month = form.cleaned_data.get('report_month') or report_date.month
         last_day = calendar.monthrange(report_year, report_month)[1]
         report_date = datetime.date(report_year, report_month, last_day)
-    data = []
-    start_date = datetime.date(report_date.year, report_date.month, 1)
-    end_date = report_date
-    incoming_count = Message.objects.filter(
-        date__range=(start_date, end_date),
-        direction='I'
-    ).count()
-    outgoing_count = Message.objects.filter(
-        date__range=(start_date, end_date),
-        direction='O'
-    ).count()
-    row = [end_date.isoformat(), incoming_count, outgoing_count]
-    data.append(row)
-    for i in range(1, 7):
-        month = report_date.month - i
-        year = report_date.year
-        if month <= 0:
-            month += 12
-            year -= 1
-        last_day = calendar.monthrange(year, month)[1]
-        start_date = datetime.date(year, month, 1)
-        end_date = datetime.date(year, month, last_day)
-        incoming_count = Message.objects.filter(
-            date__range=(start_date, end_date),
-            direction='I'
-        ).count()
-        outgoing_count = Message.objects.filter(
-            date__range=(start_date, end_date),
-            direction='O'
-        ).count()
-        row = [end_date.isoformat(), incoming_count, outgoing_count]
-        data.append(row)
-    return HttpResponse(json.dumps(data), mimetype='application/json')
+        months = form.cleaned_data.get('months') or months
+    data = monthly_message_counts(report_date, months)
+    response = HttpResponse(json.dumps(data), mimetype='application/json')
+    if is_closed_period(report_date):
+        max_age = getattr(settings, 'BROADCAST_CLOSED_REPORT_MAX_AGE', 86400)
+        patch_cache_control(response, private=True, max_age=max_age)
+    else:
+        # revalidate with the ETag on every poll
+        patch_cache_control(response, private=True, max_age=0,
+                            must_revalidate=True)
+    return response
+
+
+def last_messages_etag(request):
+    return _query_etag(request, caching.get_version('recent'))
+
+
+def last_messages_modified(request):
+    return recent_broadcasts_modified()
 
 
 @login_required
+@condition(etag_func=last_messages_etag,
+           last_modified_func=last_messages_modified)
 def last_messages(request):
     groups = []
     if request.GET:
         form = RecentMessageForm(request.GET)
         if form.is_valid():
             groups = form.cleaned_data.get('groups', [])
-    recent = Broadcast.objects.exclude(
-        Q(schedule_frequency__isnull=True) | Q(forward__isnull=False)
-    )
-    if groups:
-        recent = recent.filter(groups__in=groups)
-    confirmation_group = settings.DEFAULT_CONFIRMATIONS_GROUP_NAME
-    if not (groups and confirmation_group in [g.name for g in groups]):
-        # Don't include messages to the confirmation group unless
-        # explicitly included since it will include all the forwarded confirmations
-        recent = recent.exclude(groups__name=confirmation_group)
-    recent = recent.order_by('-date').values_list('body', flat=True).distinct()[:10]
     data = {
         'groups': u', '.join([group.name for group in groups]),
-        'messages': list(recent)
+        'messages': recent_bodies(groups),
     }
-    return HttpResponse(json.dumps(data), mimetype='application/json')
-
-
+    response = HttpResponse(json.dumps(data), mimetype='application/json')
+    patch_cache_control(response, private=True, max_age=0,
+                        must_revalidate=True)
+    return response
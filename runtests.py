@@ -24,6 +24,10 @@ if not settings.configured:
             'sorter',
             'pagination',
         ],
+        # count messages as soon as they are created, see test_count_lag
+        BROADCAST_COUNT_LAG_SECONDS=0,
+        DEFAULT_CONFIRMATIONS_GROUP_NAME='Confirmations',
+        DEFAULT_MONTHLY_REPORT_GROUP_NAME='Monthly Report',
         INSTALLED_BACKENDS={
             'mockbackend': {
                 'ENGINE': 'rapidsms.tests.harness.backend',
@@ -45,7 +49,6 @@ if not settings.configured:
         SORTER_ALLOWED_CRITERIA={
             'sort_rules': ['id', 'keyword', 'source', 'dest', 'message', 'rule_type', 'label'],
             'sort_broadcasts': ['id', 'date', 'schedule_frequency', 'body'],
-            'sort_messages': ['broadcast__id', 'broadcast__body', 'date_created', 'status', 'recipient', 'date_sent'],
         },
         TEMPLATE_CONTEXT_PROCESSORS=[
             'django.contrib.auth.context_processors.auth',